@@ -5,6 +5,14 @@ import matplotlib.pyplot as plt
 from scipy import odr
 import pickle
 import os
+import shutil
+import contextlib
+import collections
+import hashlib
+import sqlite3
+import functools
+import threading
+import concurrent.futures
 import matplotlib.patches as patches
 import matplotlib.ticker as ticker 
 
@@ -15,7 +23,19 @@ import skimage.segmentation as skseg
 import sklearn.cluster as skcluster
 import scipy.stats as sps
 import scipy.signal as spsig
+import scipy.fft as spfft
+import scipy.ndimage as spnd
+import scipy.spatial as spspatial
+import scipy.sparse as spsparse
+import scipy.sparse.csgraph as spgraph
 import imageio
+import logging
+
+#tifffile is optional, it lets a TIFF scene be memory mapped instead of decoded
+try:
+    import tifffile
+except(ImportError):
+    tifffile = None
 
 try:
     raw_input = input
@@ -24,6 +44,9 @@ except(NameError):
 
 #This is the MBARS library, it contains all the functions needed to run MBARS
 
+#progress and diagnostics, set the level on logging.getLogger('MBARS') to see more or less
+LOG = logging.getLogger('MBARS')
+
 #Global Variables, adjust as needed:
 #REFPATH is where important reference files are stored, the key one is
 # the HiRISE info file (RDRCUMINDEX.TAB) needs to be in the REFPATH folder
@@ -84,18 +107,329 @@ mindist = 3
 # mindist = 3
 
 
-'''this is called at the end to initialize the program'''
+'''this is called to initialize the program for the current ID'''
 def start():
     i,s,r,n, saz,rotang = getangles(ID)
     current()
     return i,s,r,n,saz, rotang
+
+#product ID the geometry globals were last set up for by geometry()
+GEOMID = None
+
+def geometry():
+    '''sets up the observation geometry globals (INANGLE, ROTANG...) for the current ID,
+    only does the lookup the first time a run needs it or when the ID has changed'''
+    global INANGLE,SUNANGLE,RESOLUTION,NAZ,SAZ,ROTANG,GEOMID
+    if ID is None or (GEOMID == ID and ROTANG is not None):
+        return
+    if ROTANG is None or GEOMID is not None:
+        INANGLE,SUNANGLE,RESOLUTION,NAZ,SAZ,ROTANG = start()
+    GEOMID = ID
+    return
     
 
+#module settings a panel worker needs, these are carried to the workers by runconfig
+#so that worker processes do not depend on inheriting the state of this module
+RUNSETTINGS = ['PATH','FNM','ID','NOMAP','INANGLE','SUNANGLE','RESOLUTION','ROTANG',
+               'MD','MH','MA','minA','mindist','SHADSTORE','FITBACKEND','FITPOLISH',
+               'WARMSTART','ODRPRESET','FITCACHESIZE','FITCACHEFILE',
+               'MERGESPLIT','SPLITSEED','STAGEDRUN','SCENE','TILESIZE','HALO','PANELCACHE',
+               'SAVEINTERMEDIATES','SAVEROTATED','ROIWATERSHED','ROIBATCH','LEAN']
+
+class runconfig(object):
+    '''explicit run configuration handed to every panel worker
+    holds the settings listed in RUNSETTINGS (PATH, FNM, ROTANG, INANGLE, RESOLUTION...) and the shadow bound
+    '''
+    def __init__(self, bound, **settings):
+        self.bound = bound
+        #anything not given is taken from the current module state
+        geometry()
+        self.settings = dict((a,globals()[a]) for a in RUNSETTINGS)
+        for key in settings:
+            if key not in RUNSETTINGS:
+                raise ValueError('%s is not a run setting'%(key))
+            self.settings[key] = settings[key]
+
+    def __getattr__(self, key):
+        try:
+            return self.__dict__['settings'][key]
+        except(KeyError):
+            raise AttributeError(key)
+
+    def apply(self):
+        #install the settings in this process, workers call this before doing anything
+        globals().update(self.settings)
+        return
+
+def runpanel(num, config, odr_keycard=None):
+    '''runs detection and overlap merging on one panel, the work of one process-pool worker
+    config is a runconfig, odr_keycard defaults to no lock, each process has its own ODR
+    returns the panel number and the runfile
+    '''
+    config.apply()
+    if odr_keycard is None:
+        odr_keycard = contextlib.nullcontext()
+    seg,good,runfile = autobound(num,config.bound)
+    if good:
+        if np.any(seg.compressed()):
+            panelshadows(num,seg,runfile,odr_keycard)
+    return num, runfile
+
+def processrun(panels, config, workers=None, startat=0, callback=None):
+    '''runs runpanel on panels startat to panels-1 in a pool of worker processes
+    workers - number of processes, defaults to the number of cores
+    callback - called with the finished future of every panel as it completes
+    returns the list of futures once all panels are done
+    '''
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for num in range(startat,panels):
+            future = pool.submit(runpanel, num, config)
+            if callback is not None:
+                future.add_done_callback(callback)
+            futures+=[future]
+        concurrent.futures.wait(futures)
+    return futures
+
+######Scene Mode###########
+#instead of pre-cut {FNM}{num}.PNG panels, a run can tile one large raster, the SCENE, on the fly
+#tile num is a TILESIZE square of the scene (row-major order) read with HALO extra pixels on every side,
+#so boulders crossing the tile edge are seen whole, each tile keeps only the boulders centred in its
+#core (see ownedshadows) and the scene is never cut up or copied
+SCENE = None
+TILESIZE = 2048
+HALO = 64
+
+#open scene rasters by path, each process opens a scene once
+SCENEDATA = {}
+
+def openscene(path, tilesize=None, halo=None):
+    '''sets up a scene run on the raster at path, an uncompressed PDS .IMG (or its detached .LBL),
+    a TIFF (memory mapped if tifffile is installed) or anything else imageio reads (decoded once)
+    results are written under PATH with the FNM prefix as usual, returns the number of tiles,
+    which take the place of the panels of the run'''
+    global SCENE, TILESIZE, HALO
+    if tilesize is not None:
+        TILESIZE = int(tilesize)
+    if halo is not None:
+        HALO = int(halo)
+    SCENE = os.path.abspath(path)
+    return len(scenetiles())
+
+def scenedata(path=None):
+    '''the scene raster as a 2d array, memory mapped where the format allows it'''
+    if path is None:
+        path = SCENE
+    if path not in SCENEDATA:
+        ext = os.path.splitext(path)[1].lower()
+        if ext in ('.img','.lbl'):
+            data = pdsimage(path)
+        elif ext in ('.tif','.tiff') and tifffile is not None:
+            try:
+                data = tifffile.memmap(path, mode='r')
+            except(ValueError):
+                #compressed or tiled TIFFs can not be mapped
+                data = decoded(path)
+        else:
+            data = decoded(path)
+        if data.ndim > 2:
+            data = data[...,0]
+        SCENEDATA[path] = data
+    return SCENEDATA[path]
+
+def pdslabel(path):
+    '''keyword values of a PDS3 label, attached to the top of an .IMG or a detached .LBL
+    keywords inside objects are prefixed with the object name, i.e. IMAGE.LINES'''
+    values = {}
+    obj = []
+    with open(path,'rb') as lbl:
+        for line in lbl:
+            line = line.decode('latin-1').strip()
+            if line == 'END' or lbl.tell() > 2**20:
+                break
+            if '=' not in line:
+                continue
+            key, value = [a.strip() for a in line.split('=',1)]
+            if key == 'OBJECT':
+                obj+=[value]
+            elif key == 'END_OBJECT':
+                obj = obj[:-1]
+            else:
+                values['.'.join(obj+[key])] = value.strip('"')
+    return values
+
+def pdsimage(path):
+    '''memory mapped view of the IMAGE object of a PDS3 file, only the first band is used'''
+    label = pdslabel(path)
+    folder = os.path.dirname(path)
+    pointer = [a.strip().strip('"') for a in label['^IMAGE'].strip('()').split(',')]
+    if len(pointer) == 2:
+        path = os.path.join(folder, pointer[0])
+        offset = pointer[1]
+    elif pointer[0][:1].isdigit():
+        offset = pointer[0]
+    else:
+        path = os.path.join(folder, pointer[0])
+        offset = '1'
+    #pointers count from 1, in records unless given in bytes
+    if '<BYTES>' in offset:
+        start = int(offset.replace('<BYTES>','').strip())-1
+    else:
+        start = (int(offset)-1)*int(label['RECORD_BYTES'])
+    lines = int(label['IMAGE.LINES'])
+    samples = int(label['IMAGE.LINE_SAMPLES'])
+    nbytes = int(label['IMAGE.SAMPLE_BITS'])//8
+    prefix = int(label.get('IMAGE.LINE_PREFIX_BYTES', 0))
+    rowbytes = prefix + samples*nbytes + int(label.get('IMAGE.LINE_SUFFIX_BYTES', 0))
+    stype = label['IMAGE.SAMPLE_TYPE']
+    if 'REAL' in stype or 'FLOAT' in stype:
+        kind = 'f'
+    elif 'UNSIGNED' in stype or nbytes == 1:
+        kind = 'u'
+    else:
+        kind = 'i'
+    order = '<' if any(a in stype for a in ('LSB','PC','VAX')) else '>'
+    raw = np.memmap(path, dtype=np.uint8, mode='r', offset=start, shape=(lines*rowbytes,))
+    return np.ndarray((lines,samples), dtype=np.dtype('%s%s%s'%(order,kind,nbytes)), buffer=raw,
+                      offset=prefix, strides=(rowbytes,nbytes))
+
+def scenetiles():
+    '''(core, window) of every tile of the scene in row-major order, as [y0,y1,x0,x1] pixel bounds,
+    the window is the core grown by HALO and clipped to the scene'''
+    ny, nx = scenedata().shape[:2]
+    tiles = []
+    for y0 in range(0,ny,TILESIZE):
+        for x0 in range(0,nx,TILESIZE):
+            core = [y0, min(y0+TILESIZE,ny), x0, min(x0+TILESIZE,nx)]
+            window = [max(core[0]-HALO,0), min(core[1]+HALO,ny), max(core[2]-HALO,0), min(core[3]+HALO,nx)]
+            tiles+=[(core, window)]
+    return tiles
+
+def panelimage(num, core=False):
+    '''the pixels of panel num, its PNG, or in scene mode tile num read from the scene
+    (with its halo, unless core), a read-only view of the decoded copy or the scene'''
+    if SCENE is None:
+        return decoded('%s%s%s.PNG'%(PATH,FNM,num))
+    bounds = scenetiles()[num][0 if core else 1]
+    return scenedata()[bounds[0]:bounds[1],bounds[2]:bounds[3]]
+
+#decoded copies of the PNG panels (and PNG scenes) are kept as raw .npy files in the PANELCACHE folder
+#under PATH, so every file is inflated once and read memory mapped after that, None always decodes
+PANELCACHE = 'panelcache//'
+
+def decoded(source):
+    '''the pixels of an image file, memory mapped from its decoded copy in PANELCACHE
+    the copy is made on the first read and remade whenever the source changes size or modification time'''
+    if PANELCACHE is None:
+        return np.asarray(imageio.imread(source))
+    stat = os.stat(source)
+    folder = '%s%s'%(PATH,PANELCACHE)
+    name = os.path.basename(source)
+    cachefile = '%s%s_%x_%x.npy'%(folder,name,stat.st_size,stat.st_mtime_ns)
+    try:
+        return np.load(cachefile, mmap_mode='r')
+    except(IOError, ValueError):
+        pass
+    image = np.asarray(imageio.imread(source))
+    try:
+        os.makedirs(folder, exist_ok=True)
+        #written aside and moved in, so other processes never map a partial file
+        temp = '%s.%s.tmp'%(cachefile,os.getpid())
+        with open(temp,'wb') as out:
+            np.save(out, image)
+        os.replace(temp, cachefile)
+        #copies made from older versions of the source
+        for old in os.listdir(folder):
+            if old.startswith(name+'_') and old.endswith('.npy') and folder+old != cachefile:
+                os.remove(folder+old)
+        return np.load(cachefile, mmap_mode='r')
+    except(IOError):
+        return image
+
+#rotated panels are kept (as they are, float64, in the runfile folder) so later runs of autobound and the
+#inspection tools skip the rotation, set to False to rotate every time instead
+SAVEROTATED = True
+
+def rotatedpath(runfile, num):
+    return '%s%s%s%s_rot.npy'%(PATH,runfile,FNM,num)
+
+def panelsource(num):
+    #size and modification time of the file behind panel num and its window in the scene (y0,y1,x0,x1),
+    #a stored rotation made from anything else is out of date
+    if SCENE is None:
+        stat = os.stat('%s%s%s.PNG'%(PATH,FNM,num))
+        return np.array([stat.st_size, stat.st_mtime_ns, 0, 0, 0, 0], dtype=float)
+    stat = os.stat(SCENE)
+    window = scenetiles()[num][1]
+    return np.array([stat.st_size, stat.st_mtime_ns]+list(window), dtype=float)
+
+def rotatedpanel(runfile, num):
+    '''panel num rotated by ROTANG with its edges eroded, as a plain array with the no-data set to 0,
+    None for a blank or unreadable panel, its geometry is recorded every time
+    with SAVEROTATED the rotation is done once per panel and ROTANG, stored and loaded (read-only)
+    after that, until the panel's file changes'''
+    geometry()
+    source = panelsource(num)
+    if SAVEROTATED:
+        try:
+            row = np.load(geometrypath(runfile, num))
+            if len(row) == GEOMCOLS and row[10] == ROTANG and np.array_equal(row[17:23], source):
+                image = np.load(rotatedpath(runfile, num), mmap_mode='r')
+                if image.shape == tuple(row[0:2]) and image.dtype == np.float64:
+                    return image
+        except(IOError, ValueError):
+            pass
+    try:
+       image = panelimage(num)
+    except(ValueError, SyntaxError):
+        return None
+
+    if not np.any(image):
+        return None
+    oshape = image.shape
+    tform, shape = panelrotation(oshape, ROTANG)
+    #the same warp as sktrans.rotate(image, ROTANG, resize=True), with the transform kept
+    image = sktrans.warp(image, tform, output_shape=shape, order=1, preserve_range=True)
+
+    ''' rotation seems to cause some stray data to appear at the edge, this is often
+        categorized as shadows because it is very dark but not zero, this code will
+        essentially erode the edges a bit, masking things that are adjacent to
+        the no-data in any direction (diagonals included), the panel border itself
+        is not treated as no-data
+        '''
+    valid = spnd.binary_erosion(image != 0, structure=np.ones((3,3),dtype=bool), border_value=1)
+    image[~valid] = 0
+
+    if SAVEROTATED:
+        try:
+            np.save(rotatedpath(runfile, num), image)
+        except(IOError):
+            pass
+    recordgeometry(runfile, num, oshape, image.shape, source)
+    return image
+
+def ownedshadows(runfile, num, shadows):
+    '''the shadows of tile num whose pixel centroid lies in the tile's core, the rest belong to a neighbour
+    (they are in the halo), all of them outside scene mode
+    the fitted boulder centre is not used, a bad fit can put it far outside every tile'''
+    if SCENE is None or not shadows:
+        return shadows
+    core, window = scenetiles()[num]
+    ny, nx = scenedata().shape[:2]
+    cents = np.array([a.center for a in shadows], dtype=float)
+    pos = unrotate(cents, geometryrow(runfile, num)[11:17])
+    #anything just past the edge of the scene is kept by the tile on that edge
+    ypos = np.clip(pos[:,0] + window[0], 0, ny-1)
+    xpos = np.clip(pos[:,1] + window[2], 0, nx-1)
+    owned = (ypos >= core[0]) & (ypos < core[1]) & (xpos >= core[2]) & (xpos < core[3])
+    return [shadows[i] for i in np.flatnonzero(owned)]
+
 def autobound(num,bound):
     ''' An automatic boundary-finder for HiRISE images, relies on input statistics
 '''
    
     runfile = 'autobound//'
+    geometry()
     if not os.path.exists('%s%s'%(PATH,runfile)):
         try:
             os.makedirs('%s%s'%(PATH,runfile))
@@ -104,42 +438,20 @@ def autobound(num,bound):
             #this is in case two threads try and make something at the same time
             #is it dirty? yes, does it work? also yes.
             pass
-    try:
-       image = imageio.imread('%s%s%s.PNG'%(PATH,FNM,num))
-    except(ValueError, SyntaxError):
-        return None, False, runfile
-
-    if not np.any(image.flatten()):
+    image = rotatedpanel(runfile, num)
+    if image is None:
         return None, False, runfile
-    image = sktrans.rotate(image,ROTANG, resize=True, preserve_range=True)
-    image = npma.masked_equal(image, 0)
-    
+    valid = image != 0
 
-    ''' rotation seems to cause some stray data to appear at the edge, this is often
-        categorized as shadows because it is very dark but not zero, this code will
-        essentially erode the edges a bit, shifting the mask up, down, left and right
-        and taking the logical OR of the two masks, masking things that are adjacent to
-        the mask in any direction
-        '''
-    shift = np.roll(image.mask,1,1)
-    image.mask = np.logical_or(image.mask, shift)
-    shift = np.roll(image.mask,-1,1)
-    image.mask = np.logical_or(image.mask, shift)
-    shift = np.roll(image.mask,1,0)
-    image.mask = np.logical_or(image.mask, shift) 
-    shift = np.roll(image.mask,-1,0)
-    image.mask = np.logical_or(image.mask, shift)
-    
-    imageseg = npma.copy(image)
-    imageseg = imageseg.astype(float)
-    imageseg = imageseg.filled(-1)
-
-    imageseg[imageseg>bound+1] = bound+1
-    imageseg = npma.masked_equal(imageseg, -1)    
-    imageseg = imageseg.astype(int)
-    imageseg.fill_value = 0
+    #everything brighter than the shadows is clipped to bound+1, truncated to integers in the same pass
+    imageseg = np.empty(image.shape, dtype=int)
+    np.minimum(image, bound+1, out=imageseg, casting='unsafe')
+    image = None
+    imageseg[~valid] = -1
+    imageseg = npma.masked_array(imageseg, mask=~valid, fill_value=0)
     
-    imageseg.dump("%s%s%s%s_SEG.npy"%(PATH,runfile,FNM,num))
+    if SAVEINTERMEDIATES:
+        savelabels(labelpath(runfile,num,'SEG'), imageseg)
     
     #guard against images with no shadows
     if np.min(imageseg)>= bound:
@@ -149,29 +461,114 @@ def autobound(num,bound):
     
     return(imageseg, good, runfile)
 
-def getimagebound(panels,prop):
+#the segmented (_SEG) and watershed (_flagged) images of every panel are kept for inspection
+#and for the staged merge, set to False to skip writing them
+SAVEINTERMEDIATES = True
+
+def labelpath(runfile, num, kind):
+    #kind is SEG or flagged
+    return '%s%s%s%s_%s.npz'%(PATH,runfile,FNM,num,kind)
+
+def savelabels(path, image):
+    '''saves a masked label image compactly, the values in the smallest integer dtype that holds them
+    (masked pixels as 0) and the mask as a bitmap, compressed'''
+    labels = npma.getdata(image)
+    mask = npma.getmaskarray(image)
+    if np.any(mask):
+        labels = np.where(mask, 0, labels)
+    if labels.size:
+        dtype = np.promote_types(np.min_scalar_type(labels.min()), np.min_scalar_type(labels.max()))
+    else:
+        dtype = np.uint8
+    try:
+        np.savez_compressed(path, labels=labels.astype(dtype), mask=np.packbits(mask, axis=None),
+                            shape=np.array(labels.shape))
+    except(IOError):
+        pass
+    return
+
+def loadlabels(path):
+    '''a label image saved by savelabels, as an integer masked array
+    images from older runs (the MaskedArray.dump in the .npy of the same name) are read as well'''
+    try:
+        with np.load(path) as saved:
+            shape = tuple(saved['shape'])
+            mask = np.unpackbits(saved['mask'], count=int(np.prod(shape))).reshape(shape).astype(bool)
+            return npma.masked_array(saved['labels'].astype(int), mask=mask, fill_value=0)
+    except(IOError):
+        legacy = os.path.splitext(path)[0]+'.npy'
+        if not os.path.exists(legacy):
+            raise
+        return npma.masked_array(np.load(legacy, allow_pickle=True))
+
+def getimagebound(panels,prop,seed=None):
     '''TO retrieve the overall image stats and calculate the absolute shadow boundary
 
     assumes a 2-pixel wide (4 total pixels) shadow to the minimum shadow size'''
 
+    #the histogram for the whole image is cached, so every prop reuses it
+    hist, bins = scenehistogram(panels)
+    return boundfromhist(hist,bins,prop,seed)
+
+#in-memory copies of the scene histograms, by PATH
+SCENEHIST = {}
+
+def panelhistogram(num):
+    '''1023-bin histogram of one panel, same counts as np.histogram with integer edges 0 to 1023
+    (the last bin holds 1022 and 1023), the no-data bin 0 is set to 0, tiles only count their core'''
+    im = panelimage(num, core=True)
+    if im.dtype.kind != 'u':
+        #float and signed scenes, bincount only takes non-negative integers
+        hist = np.histogram(im, bins=np.arange(1024))[0]
+        hist[0] = 0
+        return hist
+    counts = np.bincount(im.ravel(), minlength=1024)
+    hist = counts[:1023].copy()
+    hist[1022]+=counts[1023]
+    hist[0] = 0
+    return hist
+
+def scenehistogram(panels, workers=None):
+    '''histogram of all the panels of the current image, returns hist and the bin edges
+    panels are read in parallel (workers threads), the result is saved as scenehist.npz next to
+    runparams.txt and reused until any panel file changes size or modification time
+    '''
     bins = np.linspace(0,1023,1024)
     bins = bins.astype(int)
+    key = []
+    if SCENE is not None:
+        #the tile cores cover the scene exactly once
+        stat = os.stat(SCENE)
+        key+=[[stat.st_size, stat.st_mtime_ns], [panels, TILESIZE]]
+    for i in range(0,panels if SCENE is None else 0):
+        stat = os.stat('%s%s%s.PNG'%(PATH,FNM,i))
+        key+=[[stat.st_size, stat.st_mtime_ns]]
+    key = np.array(key, dtype=np.int64).reshape(-1,2)
+    if PATH in SCENEHIST and np.array_equal(SCENEHIST[PATH][0], key):
+        return SCENEHIST[PATH][1], bins
+    cachefile = '%sscenehist.npz'%(PATH)
     hist = None
-    cum_hist = None
-    #panels = 400
-    for i in range(0,panels):
-        #print i
-        im = imageio.imread('%s%s%s.PNG'%(PATH,FNM,i))
-        n,bins = np.histogram(im,bins)
-        #cum_n,bins,c=plt.hist(im.flatten(),bins,cumulative=True)
-        n[0] = 0
-        if i==0:
-            hist = n
-        else:
-            hist+=n
-
-    #we have the histogram for the whole image now.
+    try:
+        saved = np.load(cachefile)
+        if np.array_equal(saved['key'], key):
+            hist = saved['hist']
+    except(IOError, KeyError, ValueError):
+        pass
+    if hist is None:
+        hist = np.zeros(1023, dtype=np.int64)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for n in pool.map(panelhistogram, range(0,panels)):
+                hist+=n
+        try:
+            np.savez(cachefile, key=key, hist=hist)
+        except(IOError):
+            pass
+    SCENEHIST[PATH] = (key, hist)
+    return hist, bins
 
+def boundfromhist(hist,bins,prop,seed=None):
+    '''shadow boundary at percentile prop from a scene histogram, see getimagebound
+    seed makes the synthetic images (and so the boundary) reproducible'''
     mode = np.argmax(hist)
 
     #make and normalize the cumulative histogram
@@ -182,45 +579,69 @@ def getimagebound(panels,prop):
     runs = 100
     #this is important, what boundary should be chosen? I am going with the
     #average of the 100th percentile
-    stats = []
-    for i in range(runs):
-        img = ImageMaker(ncum_hist,bins)
-        #plt.imshow(img)
-        #plt.show()
-        #.77 for the lorentzian taken from
-        #Kirk et al 2008, 10.1029/2007JE003000
-        img_con = convolve_lorentzPSF(img,mode,.77)
+    #all the synthetic images are made at once
+    imgs = ImageMaker(ncum_hist,bins,runs=runs,seed=seed)
+    #.77 for the lorentzian taken from
+    #Kirk et al 2008, 10.1029/2007JE003000
+    #the whole stack is convolved at once
+    imgs_con = convolve_lorentzPSF(imgs,mode,.77)
 
-        #shadow size comes in HERE, must be same as in Image Maker function
-        shad_con = img_con[25:35,25:35]
+    #shadow size comes in HERE, must be same as in Image Maker function
+    shad_con = imgs_con[:,25:35,25:35].reshape(runs,-1)
 
-        stat = np.percentile(shad_con,prop)
-        stats+=[stat]
+    stats = np.percentile(shad_con,prop,axis=1)
 
     bound = np.average(stats)
     print ("Selected boundary at %s"%(bound))
     return bound
 
 
-def ImageMaker(mapping_hist,mapping_bins,dimx=50,dimy=50):
-    ''' returns a value from the HiRISE image population, meant to replicate what I see in MBARS'''
-       
-    img = np.random.rand(dimy,dimx)
-    for i in range(len(img)):
-        for j in range(len(img[0])):
-            for k in range(len(mapping_hist)):
-                if mapping_hist[k]>=img[i][j]:
-                    img[i][j] = float(mapping_bins[k])
+def ImageMaker(mapping_hist,mapping_bins,dimx=50,dimy=50,runs=None,seed=None):
+    ''' returns a value from the HiRISE image population, meant to replicate what I see in MBARS
+    every pixel is drawn from the cumulative histogram (the first bin that reaches a uniform draw)
+    runs - if given, a (runs,dimy,dimx) stack of images is made in one go
+    seed - seed for the random draws, for reproducible images'''
+    rng = np.random.default_rng(seed)
+    if runs is None:
+        img = rng.random((dimy,dimx))
+    else:
+        img = rng.random((runs,dimy,dimx))
+    mapping_hist = np.asarray(mapping_hist)
+    mapping_bins = np.asarray(mapping_bins, dtype=float)
+    k = np.searchsorted(mapping_hist, img, side='left')
+    #a draw above the whole histogram keeps its value, as the bin-by-bin search did
+    found = k < len(mapping_hist)
+    img[found] = mapping_bins[k[found]]
     #shadow size comes in here, must be same as above
-    img[25:35,25:35] = 1
+    img[...,25:35,25:35] = 1
     return img
     
-def convolve_lorentzPSF(image,avg,gam=.77):
-    '''convolve an array with a lorentzian HiRISE PSF'''
-    kern = lorentz_kern(31,gam)
-    #print avg
-    newimage=spsig.convolve2d(image,kern,mode='same',boundary='fill',fillvalue=avg)
+def convolve_lorentzPSF(image,avg,gam=.77,dim=31):
+    '''convolve an array with a lorentzian HiRISE PSF
+    image can be a single image or a stack of images (n,y,x), a stack is done in one batched FFT
+    the result is the same as convolve2d with mode='same', boundary='fill' and fillvalue=avg'''
+    image = np.asarray(image, dtype=float)
+    shape = image.shape[-2:]
+    kern, spectrum, fftshape = lorentz_spectrum(dim,gam,shape)
+    #filling the outside with avg is the same as convolving the image minus avg (zero fill)
+    #and adding back avg times the kernel total
+    full = spfft.irfft2(spfft.rfft2(image-avg, fftshape)*spectrum, fftshape)
+    #crop to the 'same' window
+    top = (kern.shape[0]-1)//2
+    left = (kern.shape[1]-1)//2
+    newimage = full[...,top:top+shape[0],left:left+shape[1]]+avg*np.sum(kern)
     return newimage
+
+@functools.lru_cache(maxsize=32)
+def lorentz_spectrum(dim,gam,shape):
+    '''memoized lorentzian kernel and its FFT for images of a given shape
+    returns the kernel, its real FFT and the (padded) FFT shape'''
+    kern = lorentz_kern(dim,gam)
+    fftshape = tuple(spfft.next_fast_len(a+b-1, real=True) for a,b in zip(shape,kern.shape))
+    spectrum = spfft.rfft2(kern, fftshape)
+    kern.flags.writeable = False
+    spectrum.flags.writeable = False
+    return kern, spectrum, fftshape
     
 def lorentz(x,xo,gam):
     #this is a lorentzian, a more accurate PSF for HiRISE
@@ -233,14 +654,10 @@ def lorentz_kern(dim=21,gam=.77):
     if dim%2==0:
         print("Must be odd, adding 1 to dim")
         dim+=1
-    kern = np.empty((dim,dim))
     mid = dim/2
-    for i in range(len(kern)):
-        for j in range(len(kern[0])):
-            y= float(i-mid)
-            x = float(j-mid)
-            r = np.sqrt(y**2+x**2)
-            kern[i][j] = lorentz(r,0,gam)
+    y,x = np.indices((dim,dim), dtype=float)-mid
+    r = np.sqrt(y**2+x**2)
+    kern = lorentz(r,0,gam)
     total = sum(kern.flatten())
     kern = kern/total
     #plt.imshow(kern)
@@ -249,7 +666,46 @@ def lorentz_kern(dim=21,gam=.77):
 
 #########This is the measuring side of the code#####################################
 
+#run detection and merging as two steps through the .shad file (the old flow) rather than in memory
+#slower, but leaves the unmerged detections on disk for debugging
+STAGEDRUN = False
+
+def panelshadows(num,image,runfile,odr_keycard=None):
+    '''detection and overlap merging of one panel, the shadows are passed between the two in memory
+    and the final shadows are written once, returns them
+    with STAGEDRUN set, boulderdetect_threadsafe and overlapcheck_shadbased are run through the file instead
+    '''
+    if odr_keycard is None:
+        odr_keycard = contextlib.nullcontext()
+    if STAGEDRUN:
+        boulderdetect_threadsafe(num,image,runfile,odr_keycard)
+        overlapcheck_shadbased(num,runfile,odr_keycard)
+        shades = loadshadows(runfile,num)
+        if SCENE is not None and shades is not None:
+            shades = ownedshadows(runfile,num,shades)
+            saveshadows(runfile,num,shades)
+        return shades
+    shades, fimage = detectshadows(num,image,runfile,odr_keycard)
+    shades = mergeshadows(shades,fimage,odr_keycard)
+    shades = ownedshadows(runfile,num,shades)
+    saveshadows(runfile,num,shades)
+    flushfits()
+    return shades
+
 def boulderdetect_threadsafe(num,image,runfile,odr_keycard):
+    #detects the shadows of a panel and writes them to its .shad file
+    shades, fimage = detectshadows(num,image,runfile,odr_keycard)
+    save = open("%s%s%s%s_shadows.shad"%(PATH,runfile, FNM,num), 'wb')
+    for shade in shades:
+        pickle.dump(shade,save)
+    save.close()
+    flushfits()
+
+    return
+
+def detectshadows(num,image,runfile,odr_keycard):
+    '''watershed splitting, shadow objects and fits for one segmented panel
+    returns the list of measured shadows and the flagged (watershed) image'''
     #flag must be dtype long, otherwise it will wrap at high numbers and reset the flag to 1
     #longs do not exist in python 3, leaving some compatibility in
     try:
@@ -258,57 +714,128 @@ def boulderdetect_threadsafe(num,image,runfile,odr_keycard):
     except(NameError):
         flag = 1
     coords = [0,0]
-    save = open("%s%s%s%s_shadows.shad"%(PATH,runfile, FNM,num), 'wb')
     im_area = len(image)*(len(image[0]))
+    if SCENE is not None:
+        #a tile only owns its core, the halo is counted by its neighbours
+        core = scenetiles()[num][0]
+        im_area = (core[1]-core[0])*(core[3]-core[2])
     #flagged image has the boulders marked
     #print 'Running Watershed %s\n'%(num)
     fimage = watershedmethod(image)
     #have to explicitly pass the mask on from the input image
     fimage = npma.masked_array(fimage)
-    fimage.dump('%s%s%s%s_flagged.npy'%(PATH, runfile,FNM,num))
+    if SAVEINTERMEDIATES:
+        savelabels(labelpath(runfile,num,'flagged'), fimage)
     fimage.mask = image.mask
-    fmax = np.max(fimage)
     
     #clear the seg image to save memory
     image = None
     shade=None
-    
-    for i in range(fmax+1):
-        #find all the parts of the image with a shared flag ID, these are theoretically part of a single shadow area
-        pixels = np.argwhere(fimage == i)
-        #must be converted to list for the neighbor-checking function to work
-        pixels = pixels.tolist()
-        
-        #A shdaow image will only be made if the shadow is of an appropriate size, not too big or too small
-        if len(pixels)<MA and len(pixels)>minA:
-            #Create a shadow object initialized on the list of pixels
-            shade = shadow(i, pixels, im_area)
-            
-            #broken into 3 steps to narrow the thread-unsafe part into one function
-            shade.run_prep()
-            with odr_keycard:
-                shade.run_fit()
-            shade.run_post()
-            
-            pickle.dump(shade,save)
-    save.close()
-    
-    return
+
+    #group all the flagged pixels in one pass, the size filter is applied here so
+    #no shadow objects are made for regions that are too big or too small
+    regions = regiontable(fimage, minA, MA)
+    #neighbor flags for the whole image at once, the shadows just look theirs up
+    bflags = borderflags(fimage)
+
+    shades = []
+    for i in range(len(regions['flags'])):
+        pixels = regions['pixels'][i]
+
+        #Create a shadow object initialized on the list of pixels
+        shade = shadow(regions['flags'][i], pixels, im_area)
+
+        #broken into 3 steps to narrow the thread-unsafe part into one function
+        shade.run_prep(bflags[:,regions['pixels'][i][:,0],regions['pixels'][i][:,1]])
+        shades+=[shade]
+    #the whole panel is fit in one go, so the direct backend can batch it
+    fitshadows(shades, odr_keycard)
+    for shade in shades:
+        shade.run_post()
+
+    return shades, fimage
+
+def regiontable(fimage, minarea=None, maxarea=None):
+    '''Groups every labelled pixel of a flagged image by its label in a single pass
+    masked pixels are ignored, regions are kept if minarea < area < maxarea (either may be None)
+    returns a dictionary of per-region arrays:
+    flags - the label of each region
+    area - number of pixels in each region
+    center - [y,x] centroid of each region
+    bbox - [ymin,xmin,ymax,xmax] of each region, max values are inclusive
+    pixels - list of nx2 [y,x] arrays, in the same (row-major) order np.argwhere would give
+    '''
+    labels = npma.getdata(fimage)
+    valid = ~npma.getmaskarray(fimage)
+    #flat indices of the usable pixels, already in row-major order
+    index = np.flatnonzero(valid)
+    flat = labels.ravel()[index]
+    #a stable sort keeps the row-major order within each label
+    order = np.argsort(flat, kind='stable')
+    index = index[order]
+    flat = flat[order]
+    flags, area = np.unique(flat, return_counts=True)
+
+    keep = np.ones(len(flags), dtype=bool)
+    if minarea is not None:
+        keep &= area > minarea
+    if maxarea is not None:
+        keep &= area < maxarea
+    #drop the pixels of the rejected regions, the kept ones stay grouped and in order
+    index = index[np.repeat(keep, area)]
+    flags = flags[keep]
+    area = area[keep]
+
+    if len(flags) == 0:
+        return {'flags':flags, 'area':area, 'center':np.empty((0,2)),
+                'bbox':np.empty((0,4), dtype=int), 'pixels':[]}
+    ys, xs = np.divmod(index, labels.shape[1])
+    bounds = np.concatenate([[0], np.cumsum(area)[:-1]])
+    center = np.column_stack([np.add.reduceat(ys, bounds)/area.astype(float),
+                              np.add.reduceat(xs, bounds)/area.astype(float)])
+    bbox = np.column_stack([np.minimum.reduceat(ys, bounds), np.minimum.reduceat(xs, bounds),
+                            np.maximum.reduceat(ys, bounds), np.maximum.reduceat(xs, bounds)])
+    pixels = np.split(np.column_stack([ys, xs]), bounds[1:])
+
+    return {'flags':flags, 'area':area, 'center':center, 'bbox':bbox, 'pixels':pixels}
+
+def peakgroups(points, dist):
+    '''groups points that are chained together by steps of at most dist,
+    returns the index of the first point of each point's group'''
+    pairs = spspatial.cKDTree(points).query_pairs(dist, output_type='ndarray')
+    links = spsparse.coo_matrix((np.ones(len(pairs), dtype=bool), (pairs[:,0], pairs[:,1])),
+                                shape=(len(points), len(points)))
+    labels = spgraph.connected_components(links, directed=False)[1]
+    return np.unique(labels, return_index=True)[1][labels]
             
 def watershedmethod(image):
     #this is the new way of finding the shadows in an image
-    #first find the "plateau" value, we will need this for masking
-    try:
-        #for versions of Scipy > 1.9.3
-        plat = sps.mode(image.compressed(),keepdims=True)
-    except(TypeError):
-        #for backwards compatibiltiy to pre-scipy 1.9.3
-        plat = sps.mode(image.compressed())
-        
-    #fill the image with a known value in order to preserve the mask
-    temp = image.filled(np.max(image)+1)
-    #invert the image so the shadows are peaks not lows
-    temp = temp*(-1)+np.max(image)+1
+    #the masked array is taken apart into its data and a validity mask, which are worked on directly
+    data = npma.getdata(image)
+    valid = ~npma.getmaskarray(image)
+    values = data[valid]
+    top = np.max(values)+1
+    #first find the "plateau" value (the most common one, the smallest on a tie), we will need this for masking
+    if values.dtype.kind in 'iu' and np.min(values) >= 0:
+        plat = np.argmax(np.bincount(values, minlength=top))
+    else:
+        try:
+            #for versions of Scipy > 1.9.3
+            plat = sps.mode(values,keepdims=True)[0][0]
+        except(TypeError):
+            #for backwards compatibiltiy to pre-scipy 1.9.3
+            plat = sps.mode(values)[0][0]
+    #when the plateau is the brightest value (the usual case, the image is clipped at the bound)
+    #only the pieces of the image darker than it are worked on, see roipeaks
+    roi = ROIWATERSHED and plat == top-1
+    if roi:
+        pieces = spnd.label(valid & (data != plat))[0]
+        points = roipeaks(data, valid, top, pieces)
+    else:
+        #invert the image so the shadows are peaks not lows, the no-data goes to 0
+        temp = np.negative(data)
+        temp+=top
+        temp[~valid] = 0
     #find the peaks in the image, return the points as a nx2 array
     #min_distance is a super important argument,changes the minimum distance allowed betwen maxima
     #added absolute threshold so that the background doesnt get selected...
@@ -323,51 +850,140 @@ def watershedmethod(image):
     #dropped the "indices" argument as requiested by the warning, indices is now always "true" so the argument is not needed
     #A bug is occuring that leads to massive over-splitting. This is certainly due to alot of minima occuring in large, dark areas
     #
-    points = skfeat.peak_local_max(temp,min_distance=mindist,threshold_abs = 2)
+    if not roi:
+        points = skfeat.peak_local_max(temp,min_distance=mindist,threshold_abs = 2)
 
     #put in a guard against images with no shadows where the entire image is black
     # and images where there are no minima (likely nothing that isnt masked)
-    threshold = len(image.compressed())/2
+    threshold = len(values)/2
     if len(points)>threshold or len(points)==0:
         return np.ones_like(image)
+    values = None
+    temp = None
 
     #prepare to convert the points matrix to an image-like array
-    #this could perhaps be done with DBSCAN
-    #some 0-length arrays are making it to DBSCAN, not sure why...
-    #changed eps to mindist+1, dbscan was excluding things that should have been members of the same cluster
-    cores,labels = skcluster.dbscan(points,eps=mindist+1,min_samples=2)
-    
-    view = np.zeros_like(image)
-    flag = 2
-    excl = []
-    for i in range(len(points)):
-        if labels[i] == -1:
-            view[points[i][0]][points[i][1]] = flag
-            flag+=1
-        elif labels[i] not in excl:
-            view[points[i][0]][points[i][1]] = flag
-            excl+=[labels[i]]
-            flag+=1
-
-    #this will make the mask on view mask out the originally masked points (outside data)
-    # as well as the plateau pixels
-    #it is plat[0][0] because of the output of scipy.stats.mode
-    temp = npma.masked_equal(image, plat[0][0])
-    view.mask = np.logical_or(temp.mask, view.mask)
+    #peaks within mindist+1 of each other are chained into groups (what DBSCAN with min_samples=2 finds,
+    #lone peaks are groups of their own), each group is marked by its first peak, numbered from 2 in peak order
+    first = np.flatnonzero(peakgroups(points, mindist+1) == np.arange(len(points)))
+    if roi:
+        return roiwatershed(data, pieces, points[first])
+    view = np.zeros(data.shape, dtype=data.dtype)
+    view[points[first,0],points[first,1]] = np.arange(2, len(first)+2)
+
+    #the watershed runs only on the valid pixels that are not the plateau
+    valid &= data != plat
+    view[~valid] = 0
         
     '''details on the arguments being handed to watershed:
-        in general ,the algorithm doesnt like masked arrays, hence everything is filled
+        the no-data is filled with a value above all the data
+        the mask prevents it from trying to segment all the no-data areas,
+        it is True where the pixels are used (the opposite sense of masked arrays)
         the masks are added back in the makeshadows code above
-        the mask at the ennd prevents it from trying to segment all the no-data areas
-        however it takes the mask in the opposite sense of the masked arrays
-        in ndarrays, the mask is True where you want it masked, watershed wants 0
     '''
     #changed the skmorph.watershed to skseg.watershed    
     #API suggests none of the arguments have changed, so this should be an easy swap    
-    boulds = skseg.watershed(image.filled(np.max(image)+1), view.filled(0),mask=~view.mask)
+    filled = np.where(npma.getmaskarray(image), top, data)
+    boulds = skseg.watershed(filled, view, mask=valid)
+
+    return boulds
 
+#find the watershed peaks and split the shadows a few pieces at a time (see watershedmethod), the pieces
+#are the 4-connected groups of pixels below the plateau, the labels are the same as for the whole panel
+#except that pieces too small to be shadows (minA) are left as background
+ROIWATERSHED = True
+#pixels in the box of one batch of pieces, a single bigger piece makes a batch of its own
+ROIBATCH = 2**20
+
+def domainpieces(pieces, pad=0, minarea=None):
+    '''the pieces of a label image (as made by scipy.ndimage.label) a batch at a time, as (box, mask):
+    box is a pair of slices around the batch's pieces, grown by pad and clipped to the image,
+    mask marks their pixels in the box, pieces of minarea pixels or fewer are left out
+    the labels run in row-major order, so a batch is a run of consecutive pieces'''
+    bounds = np.array([[a[0].start, a[0].stop, a[1].start, a[1].stop] for a in spnd.find_objects(pieces)],
+                      dtype=int).reshape(-1,4)
+    keep = None
+    if minarea is not None:
+        keep = np.bincount(pieces.ravel(), minlength=len(bounds)+1) > minarea
+        keep[0] = False
+    first = 0
+    while first < len(bounds):
+        y0, y1, x0, x1 = bounds[first]
+        last = first+1
+        while last < len(bounds):
+            grown = [min(y0,bounds[last,0]), max(y1,bounds[last,1]), min(x0,bounds[last,2]), max(x1,bounds[last,3])]
+            if (grown[1]-grown[0])*(grown[3]-grown[2]) > ROIBATCH:
+                break
+            y0, y1, x0, x1 = grown
+            last+=1
+        box = (slice(max(y0-pad,0), min(y1+pad,pieces.shape[0])), slice(max(x0-pad,0), min(x1+pad,pieces.shape[1])))
+        labels = pieces[box]
+        mask = (labels > first) & (labels <= last)
+        if keep is not None:
+            mask &= keep[labels]
+        first = last
+        yield box, mask
+
+def roiwatershed(data, pieces, seeds):
+    '''the watershed of data inside the pieces, flooded from the [y,x] seeds (numbered from 2 in order)
+    the flooding never crosses from one piece to another, so it is done a batch of pieces at a time
+    (see domainpieces), skimage breaks ties between equal fronts by its queue order, which can
+    (rarely) give a tied pixel to the other neighbor than a whole-panel watershed would'''
+    boulds = np.zeros(data.shape, dtype=data.dtype)
+    flags = np.arange(2, len(seeds)+2).astype(data.dtype)
+    order = np.argsort(seeds[:,0], kind='stable')
+    rows = seeds[order,0]
+    for box, mask in domainpieces(pieces, 0, minA):
+        inbox = order[np.searchsorted(rows, box[0].start):np.searchsorted(rows, box[0].stop)]
+        inbox = inbox[(seeds[inbox,1] >= box[1].start) & (seeds[inbox,1] < box[1].stop)]
+        markers = np.zeros(mask.shape, dtype=data.dtype)
+        markers[seeds[inbox,0]-box[0].start, seeds[inbox,1]-box[1].start] = flags[inbox]
+        markers[~mask] = 0
+        if np.any(markers):
+            boulds[box][mask] = skseg.watershed(data[box], markers, mask=mask)[mask]
     return boulds
 
+def roipeaks(data, valid, top, pieces):
+    '''the peaks skfeat.peak_local_max(top-data, min_distance=mindist, threshold_abs=2) finds on the
+    whole panel (no-data at 0), found only in the boxes of the pieces darker than the plateau
+    the boxes are padded by mindist so the local maxima are the same, the spacing between peaks
+    is then enforced over the whole panel, strongest first, the same way peak_local_max does'''
+    size = 2*mindist+1
+    flat = []
+    height = []
+    for box, piece in domainpieces(pieces, mindist):
+        temp = top - data[box]
+        temp[~valid[box]] = 0
+        peak = temp == spnd.maximum_filter(temp, size=size, mode='nearest')
+        peak &= temp > 2
+        peak &= piece
+        ys, xs = np.nonzero(peak)
+        flat+=[np.ravel_multi_index((ys+box[0].start, xs+box[1].start), data.shape)]
+        height+=[temp[ys,xs]]
+    if not flat:
+        return np.empty((0,2), dtype=np.intp)
+    flat = np.concatenate(flat)
+    height = np.concatenate(height)
+    #strongest first, ties in row-major order
+    flat = flat[np.lexsort((flat, -height))]
+    ys, xs = np.unravel_index(flat, data.shape)
+    #no peaks within mindist of the panel edge
+    edge = mindist
+    inside = (ys >= edge) & (ys < data.shape[0]-edge) & (xs >= edge) & (xs < data.shape[1]-edge)
+    ys = ys[inside]
+    xs = xs[inside]
+    keep = np.ones(len(ys), dtype=bool)
+    if mindist > 1:
+        #a peak closer than mindist (along either axis) to a stronger one that was kept is dropped
+        reach = int(np.ceil(mindist))-1
+        taken = np.zeros(data.shape, dtype=bool)
+        for i in range(len(ys)):
+            y, x = ys[i], xs[i]
+            if taken[y,x]:
+                keep[i] = False
+                continue
+            taken[max(y-reach,0):y+reach+1, max(x-reach,0):x+reach+1] = True
+    return np.column_stack([ys[keep], xs[keep]])
+
 #Not curently used, consdier removing###
 def overlapcheck_threadsafe_DBSCAN(num,runfile,odr_keycard,overlap=.1):
     '''
@@ -491,10 +1107,9 @@ def overlapcheck_threadsafe_DBSCAN(num,runfile,odr_keycard,overlap=.1):
                         if area > overlap:
                             #print 'Merging Boulders'
                             #if they overlap too much, make a new shadow that combines their pixels and re-run
-                            newbould=shadow(a.flag, a.pixels+b.pixels, a.im_area)
-                            newbould.run_prep()
-                            with odr_keycard:
-                                newbould.run_fit()
+                            newbould=shadow(a.flag, np.concatenate([a.pixels,b.pixels]), context=a.context)
+                            newbould.run_prep(warm=True)
+                            fitshadows([newbould], odr_keycard)
                             newbould.run_post()
 
                             #compare the fiterr
@@ -554,108 +1169,57 @@ def overlapcheck_shadbased(num,runfile,odr_keycard):
     #print(shadow_file)
     if shadow_file == None:
         return
-    parameters = []
-    while True:
-        try:
-            data = pickle.load(shadow_file)
-        except(EOFError):
-            break
-        #pull in the flag, y center of the shadow, the x center of the shadow, the border
-        parameters+=[[data.flag,data.center[0],data.center[1],data.border,data.pixels]]
-    
-    if len(parameters) == 0:
-        shadow_file.close()
-        return
-    
-    #each element in parameter is a boulder, first things first is to get the "adjacency" list
-    #each item in "adjacency" has three items, flag a, flag b, adjacency score (number of adjacent pixels in borders)
-    adjacency = []
-    for i in range(len(parameters)):
-        aflag = parameters[i][0]
-        ay = parameters[i][1]
-        ax = parameters[i][2]
-        abord = parameters[i][3]
-        apix = parameters[i][4]
-        if len(abord)==0:
-            abord = apix
-        #dont double-count pairs, this should speed things up
-        for j in range(i+1,len(parameters)):
-            #quicker check if they are super far apart
-            bflag = parameters[j][0]
-            by = parameters[j][1]
-            bx = parameters[j][2]
-            bbord = parameters[j][3]
-            bpix = parameters[j][4]
-            if len(bbord) ==0:
-                bbord=bpix
-
-            dist = np.sqrt((ay-by)**2+(ax-bx)**2)
-            if dist > sum([len(apix),len(bpix)]):
-                adjacency+=[[aflag,bflag,0]]
-                continue
-            #they are not super far away, so we can check adjacency
-            #adjacency here implies 4-neighbor, not 8-neighbor
-            D = 0
-            for k in abord:
-                for l in bbord:
-                    dist = np.sqrt((k[0]-l[0])**2+(k[1]-l[1])**2)
-                    #print(k,l,dist)
-                    if dist<=1:
-                        D+=1
-            adjacency+=[[aflag,bflag,D]]
-    #print [a for a in adjacency if a[2]>0]
-    #OK, we have the adjacency, now we need to determine the clusters.
-    #these are organized by the A flag, so lets make some webs
-    clusters = []
-    for adj in adjacency:
-        #the two flagged shadows dont touch
-        if adj[2] == 0:
-            continue
-        #they do touch
-        else:
-            #see if webs exist that contain these flags
-            if len(clusters) == 0:
-                clusters+=[[adj[0],adj[1]]]
-                continue
-            #hits will mark the clusters in which the flags are found
-            hits = []
-            for i in range(len(clusters)):
-                if adj[0] in clusters[i] or adj[1] in clusters[i]:
-                    hits+=[i]
-            if len(hits) == 0:
-                clusters+=[[adj[0],adj[1]]]
-            else:
-                newclust = []
-                hits.sort(reverse=True)
-                for i in hits:
-                    newclust+= clusters.pop(i)
-                #need to amke sure new flags get added, repeats will be there, but it doesnt actually matter
-                newclust+=[adj[0],adj[1]]
-                clusters+=[newclust]
-                
-    #clusters is now a list of clusters, adjacency is still available to reference the adjacency value for pairs
-    #return to the start of the shadows and start the merging process
-    #now lets re-read in the shadow data
-    shadow_file.seek(0)
     og_data = []
     while True:
         try:
             og_data+=[pickle.load(shadow_file)]
         except(EOFError):
             break
-    #close and re-open for re-writing
+    
     shadow_file.close()
+    if len(og_data) == 0:
+        return
+    final = mergeshadows(og_data, labelpath(runfile,num,'flagged'), odr_keycard)
+    og_data = None
+    #the file is only written once, with the final shadows
     shadow_file = getshads(runfile,num,mode='wb')
+    for i in final:
+        pickle.dump(i,shadow_file)
+    shadow_file.close()
+    if SHADSTORE:
+        writeshadstore(runfile, num, final, shadfilekey(runfile, num))
+    flushfits()
+    return
+    #return clusters,adjacency,report
 
-    prob_flags = [a for clust in clusters for a in clust]
-    problem_boulders = []
+def mergeshadows(og_data, labelfile, odr_keycard):
+    '''overlap merging of the detected shadows of a panel, see overlapcheck_shadbased
+    labelfile is the flagged (watershed) image of the panel, or the file it was saved to
+    returns the final list of shadows, untouched ones first then the results for each cluster
+    '''
+    #the adjacency comes straight from the flagged image, every distinct pair of flags that
+    #share a pixel edge (4-neighbor) touch, along with how many edges they share
+    flags = [a.flag for a in og_data]
+    labels = shadowlabels(og_data, labelfile)
+    adjacency, counts = labeladjacency(labels, flags)
+    labels = None
+    #OK, we have the adjacency, now we need to determine the clusters.
+    #touching shadows are joined, clusters keep the order of the shadow file
+    webs = unionfind(flags)
+    for adj in adjacency:
+        webs.union(adj[0],adj[1])
+    clusters = [clust for clust in webs.groups() if len(clust)>1]
+    
+    #clusters is now a list of clusters, adjacency is still available to reference the adjacency value for pairs
+    final = []
+    prob_flags = set([a for clust in clusters for a in clust])
+    problem_boulders = {}
     for i in og_data:
         if i.flag in prob_flags:
-            problem_boulders+=[i]
+            problem_boulders[i.flag] = i
         else:
             #pass
-            pickle.dump(i,shadow_file)
-    og_data = None
+            final+=[i]
 
     #for testing purposes
     report = []
@@ -665,21 +1229,22 @@ def overlapcheck_shadbased(num,runfile,odr_keycard):
         boulds = []
         avg_fiterr = 0.
         all_pixels = []
-        for rock in problem_boulders:
-            if rock.flag in clust:
-                boulds+=[rock]
-                #if the rock is one of the big ones, anything is an improvement
-                if rock.bouldwid > MD:
-                    avg_fiterr+=1000
-                    
-                elif rock.fiterr:
-                    avg_fiterr+=rock.fiterr
-                else:
-                    avg_fiterr+=1000
-                all_pixels+=rock.pixels
+        for flag in clust:
+            rock = problem_boulders[flag]
+            boulds+=[rock]
+            #if the rock is one of the big ones, anything is an improvement
+            if rock.bouldwid > MD:
+                avg_fiterr+=1000
+                
+            elif rock.fiterr:
+                avg_fiterr+=rock.fiterr
+            else:
+                avg_fiterr+=1000
+            all_pixels+=[rock.pixels]
+        all_pixels = np.concatenate(all_pixels)
         base_flag = boulds[0].flag
         #identify areas that are way too big, likely shadow-casting topography
-        #the boulder is never passed back to the file, and so it is tossed.
+        #the boulder is never passed back, and so it is tossed.
         
         if len(all_pixels) > 5000:
             #print base_flag
@@ -688,28 +1253,111 @@ def overlapcheck_shadbased(num,runfile,odr_keycard):
             
         avg_fiterr = avg_fiterr
         #now, merge the pixels and see if it is better.
-        newbould=shadow(base_flag, all_pixels, boulds[0].im_area)
-        newbould.run_prep()
-        with odr_keycard:
-            newbould.run_fit()
+        newbould=shadow(base_flag, all_pixels, context=boulds[0].context)
+        newbould.run_prep(warm=True)
+        fitshadows([newbould], odr_keycard)
         newbould.run_post()
         #consider which is better?
         #new one exists, is better, and is smaller than max
         #print 'considering cluster %s'%(clust)
         #print 'New fiterr = %s, avg_fiterr = %s'%(newbould.fiterr,avg_fiterr)
         if newbould.fiterr and newbould.fiterr < avg_fiterr and newbould.bouldwid < MD:
-            pickle.dump(newbould,shadow_file)
+            final+=[newbould]
             #report+=['New boulder was better']
      
         #Lets try a k-means based method
         else:
             #print newbould.bouldwid
-            kmeans_shadowmerge(boulds,shadow_file,odr_keycard,avg_fiterr)
-            
+            final+=kmeanssplit(boulds,odr_keycard,avg_fiterr)
             
-    return
-    #return clusters,adjacency,report
+    return final
                 
+def shadowlabels(shadows, labelfile=None):
+    '''label image of a set of shadow objects, each pixel holds the flag of its shadow
+    the watershed image in labelfile (the image itself or the file it was saved to) is used if it still
+    matches the shadows, otherwise (missing file, or shadows already merged) the shadow pixels are
+    rasterized, other pixels are -1'''
+    flags = np.array([a.flag for a in shadows])
+    areas = np.array([len(a.pixels) for a in shadows])
+    if labelfile is not None and 0 not in flags:
+        #0 is also the watershed background, so a shadow flagged 0 can only be rasterized
+        if not isinstance(labelfile, str):
+            labels = npma.getdata(labelfile)
+        else:
+            try:
+                labels = npma.getdata(loadlabels(labelfile))
+            except(IOError):
+                labels = None
+        if labels is not None and labels.ndim == 2:
+            found = np.bincount(labels.ravel().clip(0), minlength=flags.max()+1)
+            if np.array_equal(found[flags], areas):
+                return labels
+    pixels = np.concatenate([np.asarray(a.pixels, dtype=int).reshape(-1,2) for a in shadows])
+    labels = np.full(pixels.max(axis=0)+1, -1, dtype=int)
+    labels[pixels[:,0],pixels[:,1]] = np.repeat(flags, areas)
+    return labels
+
+def labeladjacency(labels, flags=None):
+    '''finds every distinct pair of labels that touch across a pixel edge (4-neighbor)
+    only labels in flags are considered if it is given, everything else is background
+    returns an nx2 array of [a,b] pairs (a<b) and the number of pixel edges each pair shares
+    '''
+    labels = np.asarray(npma.getdata(labels))
+    if flags is None:
+        flags = np.unique(labels[labels>0])
+    flags = np.asarray(flags, dtype=int)
+    if len(flags) == 0:
+        return np.empty((0,2), dtype=int), np.empty(0, dtype=int)
+    top = max(labels.max(), flags.max())+1
+    #lookup table for which labels count
+    inset = np.zeros(top+1, dtype=bool)
+    inset[flags] = True
+    lab = np.where((labels>=0)&(labels<top), labels, top)
+    keys = []
+    #horizontal then vertical pixel edges
+    for a,b in ((lab[:,:-1],lab[:,1:]),(lab[:-1,:],lab[1:,:])):
+        sel = (a!=b)&inset[a]&inset[b]
+        a = a[sel]
+        b = b[sel]
+        keys += [np.minimum(a,b).astype(np.int64)*(top+1)+np.maximum(a,b)]
+    keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+    pairs = np.column_stack(np.divmod(keys, top+1))
+    return pairs, counts
+
+class unionfind(object):
+    '''disjoint sets of flags, used to gather touching shadows into clusters'''
+    def __init__(self, items):
+        self.items = list(items)
+        self.parent = dict((i,i) for i in self.items)
+        self.size = dict((i,1) for i in self.items)
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        #compress the path on the way out
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a,b = b,a
+        self.parent[b] = a
+        self.size[a]+=self.size[b]
+        return a
+
+    def groups(self):
+        #sets in order of their first member, members in the order they were given
+        groups = {}
+        for i in self.items:
+            groups.setdefault(self.find(i),[]).append(i)
+        return list(groups.values())
+
 #not currently in use      
 def exclusive_shadowmerge(boulds,mincon,shadowfile,odr_keycard):
     ''' Calls the shadowmerge method, recursively tries to make new boulders from adjacent shadows
@@ -726,14 +1374,14 @@ def exclusive_shadowmerge(boulds,mincon,shadowfile,odr_keycard):
                 avg_fiterr+=rock[0].fiterr
             else:
                 avg_fiterr+=100
-            all_pixels+=rock[0].pixels
+            all_pixels+=[rock[0].pixels]
+        all_pixels = np.concatenate(all_pixels)
         base_flag = inboulds[0][0].flag
         avg_fiterr = avg_fiterr/(float(len(inboulds)))
         #now, merge the pixels and see if it is better.
-        newbould=shadow(base_flag, all_pixels, inboulds[0][0].im_area)
-        newbould.run_prep()
-        with odr_keycard:
-            newbould.run_fit()
+        newbould=shadow(base_flag, all_pixels, context=inboulds[0][0].context)
+        newbould.run_prep(warm=True)
+        fitshadows([newbould], odr_keycard)
         newbould.run_post()
         if newbould.fiterr and newbould.fiterr < avg_fiterr and newbould.bouldwid < MD:
             pickle.dump(newbould,shadowfile)
@@ -745,12 +1393,105 @@ def exclusive_shadowmerge(boulds,mincon,shadowfile,odr_keycard):
         for rock in boulds:
             pickle.dump(rock[0],shadowfile)
 
-#Used in the overlap check_Shadbased
+#how kmeans_shadowmerge splits a cluster, 'kmeans' tries k-means for every k up to the number of shadows,
+#'bisect' splits the worst piece in two at a time and stops once splitting no longer helps
+MERGESPLIT = 'kmeans'
+#seed the splits across x at the mean y, favoring boulders side by side over splits along the sun line
+SPLITSEED = False
+
+def sunseeds(pixels, k):
+    '''k starting centers for k-means, spread evenly across the x range of the pixels (ends removed)
+    at their mean y, [y,x] like the pixels'''
+    xs = np.linspace(np.min(pixels[:,1]), np.max(pixels[:,1]), k+2)[1:-1]
+    return np.column_stack([np.full(k, np.average(pixels[:,0])), xs])
+
+def mergecost(shade):
+    #fit error a shadow adds to a merge candidate, ones too big or not fit count as 1000
+    if shade.bouldwid > MD:
+        return 1000
+    elif shade.fiterr:
+        return shade.fiterr
+    return 1000
+
+def bisectshadow(piece, flag, odr_keycard):
+    '''splits a shadow in two with 2-means, the first half keeps its flag and the second gets flag
+    returns the two measured halves, None if the shadow can not be split'''
+    pixels = piece.pixels
+    if len(pixels) < 2:
+        return None
+    if SPLITSEED:
+        kmeans = skcluster.KMeans(n_clusters=2, init=sunseeds(pixels,2), n_init=1).fit(pixels)
+    else:
+        kmeans = skcluster.KMeans(n_clusters=2).fit(pixels)
+    halves = []
+    for j, newflag in ((0,piece.flag),(1,flag)):
+        pix = pixels[kmeans.labels_ == j]
+        if len(pix) == 0:
+            return None
+        halves+=[shadow(newflag, pix, context=piece.context)]
+        halves[-1].run_prep(warm=True)
+    fitshadows(halves, odr_keycard)
+    for half in halves:
+        half.run_post()
+    return halves
+
+def bisect_shadowmerge(boulds, odr_keycard, avg_fiterr):
+    '''hierarchical alternative to the k-means sweep of kmeans_shadowmerge
+    the piece with the worst fit is split in two as long as that lowers the summed fit error
+    (or the piece is too big to keep), pieces that did not split well are not tried again, at most one piece per original shadow
+    returns the pieces if they beat avg_fiterr, otherwise the original shadows
+    '''
+    all_pixels = np.concatenate([a.pixels for a in boulds])
+    all_flags = [a.flag for a in boulds]
+    #the whole cluster is the root of the splits, its fit is normally already cached from the merge attempt
+    whole = shadow(all_flags[0], all_pixels, context=boulds[0].context)
+    whole.run_prep(warm=True)
+    fitshadows([whole], odr_keycard)
+    whole.run_post()
+    pieces = [whole]
+    costs = [mergecost(whole)]
+    done = [False]
+    while len(pieces) < len(all_flags):
+        improved = False
+        for i in np.argsort(costs)[::-1]:
+            if done[i]:
+                continue
+            halves = bisectshadow(pieces[i], all_flags[len(pieces)], odr_keycard)
+            if halves is None:
+                done[i] = True
+                continue
+            #a piece too big to be a boulder is always split, its halves may need splitting in turn
+            if mergecost(halves[0])+mergecost(halves[1]) < costs[i] or pieces[i].bouldwid > MD:
+                pieces[i] = halves[0]
+                costs[i] = mergecost(halves[0])
+                done[i] = False
+                pieces+=[halves[1]]
+                costs+=[mergecost(halves[1])]
+                done+=[False]
+                improved = True
+                break
+            done[i] = True
+        if not improved:
+            break
+    if len(pieces) > 1 and sum(costs) <= avg_fiterr:
+        return pieces
+    return boulds
+
 def kmeans_shadowmerge(boulds,shadowfile,odr_keycard,avg_fiterr):
     #boudlds is a list of shadow objects, shadowfile is the targeted shadow file, should be in "write" mode
+    #the shadows kmeanssplit settles on are written to it
+    for i in kmeanssplit(boulds,odr_keycard,avg_fiterr):
+        pickle.dump(i,shadowfile)
+    return()
+
+#Used in the overlap check_Shadbased
+def kmeanssplit(boulds,odr_keycard,avg_fiterr):
+    #boudlds is a list of shadow objects, returns the list of shadows to keep in their place
     #odr-keycard is the thread lock object to prevent multiple access to ODR, maxboulds is the highest k-means will go
     #avg_fiterr is the average fit error on the original boulders, we have to be better
-    all_pixels = [b for a in boulds for b in a.pixels]
+    if MERGESPLIT == 'bisect':
+        return bisect_shadowmerge(boulds, odr_keycard, avg_fiterr)
+    all_pixels = np.concatenate([a.pixels for a in boulds])
     #this is a list of all flags, maxbolds is limited by the length of this list
     all_flags = [a.flag for a in boulds]
     maxboulds = len(all_flags)
@@ -760,19 +1501,10 @@ def kmeans_shadowmerge(boulds,shadowfile,odr_keycard,avg_fiterr):
     for i in range(2,maxboulds+1):
         #lets try manually seeding to limit splits along the sun-line
         #by seeding the k-means as an equal x-spread, this should strongly favor lateral boulders rather than vertical
-        minx = min([a[1] for a in all_pixels])
-        maxx = max([a[1] for a in all_pixels])
-        avgy = np.average([a[0] for a in all_pixels])
-        #make a linspace that goes from min to max, then remove the ends.
-        seeds  = list(np.linspace(minx,maxx,i+2))
-        seeds.pop(0)
-        seeds.pop(-1)
-        seeds = map(lambda x: (x,avgy),seeds)
-        seeds = [list(a) for a in seeds]
-        seeds = np.array(seeds)
-        #kmeans = skcluster.KMeans(n_clusters=i,init = seeds).fit(all_pixels)
-        kmeans = skcluster.KMeans(n_clusters=i).fit(all_pixels)
-        labelpix = [list(a) for a in zip(kmeans.labels_,all_pixels)]
+        if SPLITSEED:
+            kmeans = skcluster.KMeans(n_clusters=i,init = sunseeds(all_pixels,i),n_init=1).fit(all_pixels)
+        else:
+            kmeans = skcluster.KMeans(n_clusters=i).fit(all_pixels)
         #cents = kmeans.cluster_centers_
         #print(kmeans.labels_)
         #for display purposes
@@ -787,16 +1519,14 @@ def kmeans_shadowmerge(boulds,shadowfile,odr_keycard,avg_fiterr):
         newboulds = []
         new_fiterr = 0
         for j in range(i):
-            pix = []
-            for a in labelpix:
-                if a[0] == j:
-                    pix+=[a[1]]
-            newbould = shadow(all_flags[j],pix,boulds[0].im_area)
-            newbould.run_prep()
-            with odr_keycard:
-                newbould.run_fit()
-            newbould.run_post()
+            pix = all_pixels[kmeans.labels_ == j]
+            newbould = shadow(all_flags[j],pix,context=boulds[0].context)
+            newbould.run_prep(warm=True)
             newboulds+=[newbould]
+        #all k pieces are fit together
+        fitshadows(newboulds, odr_keycard)
+        for newbould in newboulds:
+            newbould.run_post()
             if newbould.bouldwid > MD:
                 new_fiterr+=1000
             elif newbould.fiterr:
@@ -813,15 +1543,11 @@ def kmeans_shadowmerge(boulds,shadowfile,odr_keycard,avg_fiterr):
     if min(newerrs_list)<= avg_fiterr:
         #we found a better solution
         #print "%s is best fit"%(np.argmin(newerrs_list)+2)
-        final_boulders = newboulds_list[np.argmin(newerrs_list)]
-        for i in final_boulders:
-            pickle.dump(i,shadowfile)
+        return newboulds_list[np.argmin(newerrs_list)]
     else:
         #no better solution was found
         #print "no better fit was found"
-        for i in boulds:
-            pickle.dump(i,shadowfile)
-    return()
+        return boulds
             
 #called in an unused dunction, consider removing
 def checkpos(shadow1,shadow2):
@@ -870,47 +1596,418 @@ def checkpos(shadow1,shadow2):
         area = area/(np.pi*rb**2)
         return area
     
+######Shadow Border Engine###########
+def borderflags(labels, background=-1):
+    '''For every pixel of a label image (or boolean mask), marks which of its 4 neighbors
+    belong to a different label. Masked pixels and pixels beyond the image edge are
+    treated as background. Works on a single shadow mask or a whole flagged image.
+    returns a (4,ny,nx) boolean array, ordered up (-y), down (+y), right (+x), left (-x)
+    '''
+    labels = npma.filled(labels, background)
+    pad = np.pad(labels, 1, mode='constant', constant_values=background)
+    flags = np.empty((4,)+labels.shape, dtype=bool)
+    np.not_equal(pad[:-2,1:-1], labels, out=flags[0])
+    np.not_equal(pad[2:,1:-1], labels, out=flags[1])
+    np.not_equal(pad[1:-1,2:], labels, out=flags[2])
+    np.not_equal(pad[1:-1,:-2], labels, out=flags[3])
+    return flags
+
+def pixelflags(pixels):
+    '''neighbor flags (see borderflags) for a set of [y,x] pixels, returned as a (4,n) array in pixel order
+    the pixels are rasterized into a mask just big enough to hold them'''
+    pixels = np.asarray(pixels, dtype=int).reshape(-1,2)
+    local = pixels - pixels.min(axis=0)
+    mask = np.zeros(local.max(axis=0)+1, dtype=bool)
+    mask[local[:,0],local[:,1]] = True
+    return borderflags(mask, False)[:,local[:,0],local[:,1]]
+
+def shadowborders(pixels, flags=None):
+    '''border, mirror border and flip axis of a shadow, pixel-center version (see shadow.findborder_cents)
+    the points and their order are the same as a pixel by pixel neighbor search gives,
+    a pixel is repeated once for every open side that adds it to a list
+    returns three arrays, border and mborder are [y,x] pixels, flipaxis is [y-.5,x] of the top pixels
+    '''
+    pixels = np.asarray(pixels, dtype=int).reshape(-1,2)
+    if flags is None:
+        flags = pixelflags(pixels)
+    up, down, right, left = flags
+    #once for a top pixel, otherwise once for every other open side
+    nborder = np.where(up, 1, down.astype(int)+right+left)
+    #once for a bottom pixel, never for a top pixel, otherwise once for each open side
+    nmborder = np.where(down, 1, np.where(up, 0, right.astype(int)+left))
+    border = np.repeat(pixels, nborder, axis=0)
+    mborder = np.repeat(pixels, nmborder, axis=0)
+    flipaxis = pixels[up]-[.5,0.]
+    return border, mborder, flipaxis
+
+#corner offsets used by the edge based border, two points per side, ordered as in borderflags
+EDGEOFFSETS = np.array([[[-.5,0.],[-.5,.5]],
+                        [[.5,0.],[.5,-.5]],
+                        [[0.,.5],[.5,.5]],
+                        [[0.,-.5],[-.5,-.5]]])
+
+def shadowedges(pixels, flags=None):
+    '''border, mirror border and flip axis of a shadow, pixel-edge version (see shadow.findborder)
+    returns three arrays of [y,x] points in the same order as a pixel by pixel neighbor search
+    '''
+    pixels = np.asarray(pixels, dtype=int).reshape(-1,2)
+    if flags is None:
+        flags = pixelflags(pixels)
+    up, down, right, left = flags
+    #every pixel has two candidate points on each side, shape (n,4,2,2)
+    points = pixels[:,None,None,:]+EDGEOFFSETS
+    sides = np.transpose(flags)
+    msides = np.column_stack([np.zeros_like(up), down, right&~up, left&~up])
+    fsides = np.column_stack([up, np.zeros_like(up), np.zeros_like(up), np.zeros_like(up)])
+    pair = np.ones(2, dtype=bool)
+    border = points[sides[:,:,None]&pair]
+    mborder = points[msides[:,:,None]&pair]
+    flipaxis = points[fsides[:,:,None]&pair]
+    return border, mborder, flipaxis
+
+######Ellipse Fitting###########
+#how the mirrored borders are fit, 'odr' fits each shadow on its own with scipy.odr,
+#'direct' fits all the shadows of a panel at once with the direct least-squares ellipse fit
+FITBACKEND = 'odr'
+#with the direct backend, shadows the direct fit could not handle are re-fit with ODR
+FITPOLISH = True
+#start merge candidates from the second moments of their pixels rather than a 2 pixel circle
+WARMSTART = True
+#ODR iteration limit and stopping tolerances, None leaves the ODRPACK default
+#var_calc 2 skips the parameter covariance, it is never used
+ODRPRESETS = {'exact':{'maxit':200,'sstol':None,'partol':None},
+              'default':{'maxit':None,'sstol':None,'partol':None},
+              'fast':{'maxit':20,'sstol':1e-5,'partol':1e-6}}
+ODRPRESET = 'default'
+
+#fit results are remembered by fitkey, FITCACHESIZE fits in memory (0 turns that off)
+#and every fit in the sqlite file FITCACHEFILE if it is set, which workers can share (written once per panel)
+FITCACHESIZE = 20000
+FITCACHEFILE = None
+#bump when a change to the fitting would give different results for the same pixels
+FITVERSION = 1
+FITCACHE = None
+
+def fitshadows(shadows, odr_keycard=None):
+    '''fits the mirrored borders of a list of prepared shadows (after run_prep) with FITBACKEND
+    odr_keycard is the lock held around every ODR fit, defaults to no lock
+    shadows already fit with the same pixels and settings take their result from the fit cache
+    '''
+    if odr_keycard is None:
+        odr_keycard = contextlib.nullcontext()
+    todo = [a for a in shadows if a.mborder is not None and len(a.mborder) != 0]
+    cache = getfitcache()
+    if cache is None:
+        runfits(todo, odr_keycard)
+        return
+    keys = [fitkey(a) for a in todo]
+    found = cache.get(keys)
+    missed = []
+    for i in range(len(todo)):
+        if found[i] is None:
+            missed+=[i]
+        else:
+            beta, err, info, good = found[i]
+            todo[i].setfit(np.array(beta), err, info)
+            todo[i].fitgood = good
+    runfits([todo[i] for i in missed], odr_keycard)
+    cache.put([keys[i] for i in missed],
+              [(todo[i].fitbeta, todo[i].fiterr, todo[i].fitinfo, todo[i].fitgood) for i in missed])
+    return
+
+def fitkey(shade):
+    '''hash of everything that decides the fit of a prepared shadow: its pixels (in sorted order),
+    the starting point, the scene values and the fit settings'''
+    pixels = shade.pixels[np.lexsort((shade.pixels[:,1], shade.pixels[:,0]))]
+    key = hashlib.sha1(np.ascontiguousarray(pixels, dtype=np.int32).tobytes())
+    key.update(np.asarray(shade.fitinit, dtype=float).tobytes())
+    key.update(repr((FITVERSION, FITBACKEND, FITPOLISH, ODRPRESET, MA, minA,
+                     shade.inangle, shade.resolution)).encode())
+    return key.hexdigest()
+
+def getfitcache():
+    '''the fit cache for the current FITCACHESIZE and FITCACHEFILE, None if caching is off'''
+    global FITCACHE
+    if FITCACHESIZE <= 0 and FITCACHEFILE is None:
+        return None
+    if FITCACHE is None or (FITCACHE.size, FITCACHE.path) != (FITCACHESIZE, FITCACHEFILE):
+        if FITCACHE is not None:
+            FITCACHE.flush()
+        FITCACHE = fitcache(FITCACHESIZE, FITCACHEFILE)
+    return FITCACHE
+
+def flushfits():
+    #writes the new fits of the fit cache to FITCACHEFILE, called once a panel is done
+    if FITCACHE is not None:
+        FITCACHE.flush()
+
+class fitcache(object):
+    '''least recently used fit results (fitbeta, fiterr, fitinfo, fitgood) by fitkey,
+    optionally backed by an sqlite file, each process opens its own connection to it (shared by its threads)
+    new fits are written to the file in one transaction by flush, once per panel
+    the threads of a process share the cache, everything it holds is only touched under its lock'''
+    def __init__(self, size, path=None):
+        self.size = max(size, 0)
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.pending = collections.OrderedDict()
+        self.conn = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.lockpid = os.getpid()
+
+    def mutex(self):
+        #a lock held by another thread during a fork stays held in the child, so each process makes its own
+        if self.lockpid != os.getpid():
+            self.lock = threading.Lock()
+            self.lockpid = os.getpid()
+        return self.lock
+
+    def connect(self):
+        #called with the lock held
+        if self.path is None:
+            return None
+        if self.pid != os.getpid():
+            #timeout is how long a write waits on another process (the busy timeout), WAL lets
+            #the readers carry on while it does
+            self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, beta BLOB, err REAL, info TEXT, good INTEGER)')
+            self.conn.commit()
+            self.pid = os.getpid()
+        return self.conn
+
+    def remember(self, key, result):
+        #called with the lock held
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, keys):
+        #list of results in the order of keys, None where the fit is not known
+        with self.mutex():
+            found = []
+            for key in keys:
+                result = self.entries.get(key)
+                if result is not None:
+                    self.entries.move_to_end(key)
+                else:
+                    result = self.pending.get(key)
+                found+=[result]
+            missing = [keys[i] for i in range(len(keys)) if found[i] is None]
+            conn = self.connect()
+            if conn is None or len(missing) == 0:
+                return found
+            stored = {}
+            #stay under the sqlite limit on query parameters
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i+500]
+                rows = conn.execute('SELECT key, beta, err, info, good FROM fits WHERE key IN (%s)'%(','.join('?'*len(chunk))), chunk)
+                for row in rows:
+                    stored[row[0]] = (np.frombuffer(row[1]).copy(), row[2], row[3], bool(row[4]))
+            for i in range(len(keys)):
+                if found[i] is None and keys[i] in stored:
+                    found[i] = stored[keys[i]]
+                    self.remember(keys[i], found[i])
+        return found
+
+    def put(self, keys, results):
+        results = [(np.array(a[0], dtype=float), a[1], a[2], bool(a[3])) for a in results]
+        with self.mutex():
+            for i in range(len(keys)):
+                self.remember(keys[i], results[i])
+                if self.path is not None:
+                    self.pending[keys[i]] = results[i]
+
+    def flush(self):
+        #writes the fits put since the last flush to the sqlite file
+        with self.mutex():
+            conn = self.connect()
+            if conn is None or len(self.pending) == 0:
+                return
+            pending, self.pending = self.pending, collections.OrderedDict()
+            conn.executemany('INSERT OR REPLACE INTO fits VALUES (?,?,?,?,?)',
+                             [(key, a[0].tobytes(), None if a[1] is None else float(a[1]), a[2], int(a[3]))
+                              for key, a in pending.items()])
+            conn.commit()
+
+def runfits(shadows, odr_keycard):
+    #the fitting part of fitshadows, shadows all have a mirrored border
+    todo = shadows
+    if FITBACKEND == 'odr':
+        for shade in todo:
+            with odr_keycard:
+                shade.odrfit_m()
+        return
+    if FITBACKEND != 'direct':
+        raise ValueError('unknown fit backend %s'%(FITBACKEND))
+    betas, errs, ok = ellipsefits([a.mborder for a in todo])
+    for i in range(len(todo)):
+        shade = todo[i]
+        if ok[i]:
+            shade.setfit(betas[i], errs[i], '1')
+        #only the fits that failed, or came out too big to keep, are worth the ODR
+        if FITPOLISH and not (ok[i] and shade.fitgood):
+            with odr_keycard:
+                shade.odrfit_m(betas[i] if ok[i] else None)
+        elif not ok[i]:
+            #unpolished failure, recorded like an ODR that ran out of iterations
+            shade.setfit(shade.fitinit, None, '5')
+    return
+
+def ellipsefits(borders):
+    '''direct least-squares ellipse fits (Halir and Flusser, 1998) of many point sets at once
+    borders is a list of nx2 [y,x] arrays, every set needs at least one point
+    returns an mx5 array of [yc, ay, xc, ax, alpha] in the layout of shadow.ellipse,
+    the Sampson estimate of the orthogonal sum of squares (what ODR reports as sum_square)
+    and whether each fit is actually an ellipse, the rest of a failed row is meaningless
+    '''
+    m = len(borders)
+    if m == 0:
+        return np.empty((0,5)), np.empty(0), np.empty(0, dtype=bool)
+    sizes = np.array([len(a) for a in borders])
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    owner = np.repeat(np.arange(m), sizes)
+    pts = np.concatenate(borders).astype(float)
+    #center and scale each set, the conic normal equations are badly conditioned otherwise
+    mean = np.add.reduceat(pts, starts, axis=0)/sizes[:,None]
+    d = pts - mean[owner]
+    scale = np.sqrt(np.add.reduceat((d**2).sum(axis=1), starts)/sizes)
+    scale[scale == 0] = 1.
+    u = d[:,0]/scale[owner]
+    v = d[:,1]/scale[owner]
+    #scatter matrix of the conic a*u^2 + b*uv + c*v^2 + d*u + e*v + f, one per set
+    design = np.column_stack([u*u, u*v, v*v, u, v, np.ones_like(u)])
+    scatter = np.add.reduceat(design[:,:,None]*design[:,None,:], starts, axis=0)
+    s1 = scatter[:,:3,:3]
+    s2 = scatter[:,:3,3:]
+    s3 = scatter[:,3:,3:]
+    #collinear sets have a singular linear block and no ellipse
+    ok = np.abs(np.linalg.det(s3)) > 1e-9*np.maximum(1., sizes)**3
+    s3 = np.where(ok[:,None,None], s3, np.eye(3))
+    t = -np.linalg.solve(s3, np.transpose(s2, (0,2,1)))
+    reduced = s1 + s2 @ t
+    #premultiply by the inverse of the ellipse constraint matrix
+    reduced = np.stack([reduced[:,2]/2., -reduced[:,1], reduced[:,0]/2.], axis=1)
+    with np.errstate(all='ignore'):
+        vecs = np.linalg.eig(reduced)[1].real
+    #the ellipse is the eigenvector with 4ac - b^2 > 0
+    cond = 4*vecs[:,0,:]*vecs[:,2,:] - vecs[:,1,:]**2
+    pick = np.argmax(cond, axis=1)
+    rows = np.arange(m)
+    quad = vecs[rows,:,pick]
+    ok &= cond[rows,pick] > 0
+    lin = (t @ quad[:,:,None])[:,:,0]
+    a, b, c = quad.T
+    dl, el, fl = lin.T
+    with np.errstate(all='ignore'):
+        #center of the conic
+        det = 4*a*c - b**2
+        uc = (b*el - 2*c*dl)/det
+        vc = (b*dl - 2*a*el)/det
+        f0 = fl + (dl*uc + el*vc)/2.
+        #principal axes of the quadratic part, columns of axes are unit [y,x] directions
+        form = np.stack([np.stack([a, b/2.], axis=1), np.stack([b/2., c], axis=1)], axis=1)
+        lam, axes = np.linalg.eigh(np.where(ok[:,None,None], form, np.eye(2)))
+        semi = np.sqrt(-f0[:,None]/lam)*scale[:,None]
+    ok &= np.all(np.isfinite(semi), axis=1) & np.all(semi > 0, axis=1)
+    #ay goes with the axis closer to y, as it would from ODR's start at alpha = 0
+    first = np.argmax(np.abs(axes[:,0,:]), axis=1)
+    e1 = axes[rows,:,first]
+    alpha = np.arctan(e1[:,1]/e1[:,0])
+    betas = np.column_stack([mean[:,0]+uc*scale, semi[rows,first], mean[:,1]+vc*scale,
+                             semi[rows,1-first], alpha])
+    ok &= np.all(np.isfinite(betas), axis=1)
+    betas[~ok] = 0.
+    betas[~ok,1] = 1.
+    betas[~ok,3] = 1.
+    errs = sampsonerror(betas, pts, owner, starts)
+    ok &= np.isfinite(errs)
+    return betas, errs, ok
+
+def sampsonerror(betas, pts, owner, starts):
+    '''first order estimate of the sum of squared orthogonal distances from each ellipse to its points,
+    f^2/|grad f|^2 of the implicit model shadow.ellipse summed over the points of each set'''
+    yc, ay, xc, ax, alpha = betas[owner].T
+    cos = np.cos(alpha)
+    sin = np.sin(alpha)
+    dy = pts[:,0] - yc
+    dx = pts[:,1] - xc
+    p = dy*cos + dx*sin
+    q = dx*cos - dy*sin
+    val = (p/ay)**2 + (q/ax)**2 - 1
+    gy = 2*p*cos/ay**2 - 2*q*sin/ax**2
+    gx = 2*p*sin/ay**2 + 2*q*cos/ax**2
+    with np.errstate(all='ignore'):
+        dist = val**2/(gy**2 + gx**2)
+    return np.add.reduceat(dist, starts)
+
 ######Shadow Object Definition###########
-class shadow(object):
+#drop the border geometry of shadows once they are measured, keeps only what analysis needs
+LEAN = False
+
+#shared shadow contexts, by value
+SHADOWCONTEXTS = {}
+
+def sharedcontext(inangle, resolution, im_area):
+    '''the one shadowcontext for a set of scene values, so shadows of a run share it'''
+    key = (inangle, resolution, im_area)
+    if key not in SHADOWCONTEXTS:
+        SHADOWCONTEXTS[key] = shadowcontext(inangle, resolution, im_area)
+    return SHADOWCONTEXTS[key]
+
+class shadowcontext(object):
+    '''scene-wide values shared by all the shadows of a panel, rather than copied into each one'''
+    __slots__ = ('inangle','resolution','im_area')
+
+    def __init__(self, inangle, resolution, im_area):
+        #incedence angle of the sun, fixed by target image
+        self.inangle = inangle
+        #image resolution
+        self.resolution = resolution
+        #image area (pixels^2)
+        self.im_area = im_area
+
+    def __reduce__(self):
+        #unpickled contexts are shared again
+        return (sharedcontext, (self.inangle, self.resolution, self.im_area))
 
-    def __init__(self, flag, pixels, im_area):
+class shadow(object):
+    __slots__ = ('flag','pixels','area','context','center','border','mborder','flipaxis','fitinit',
+                 'fitbeta','fitgood','fiterr','fitinfo','measured','bouldwid','bouldwid_m',
+                 'bouldheight','bouldheight_m','bouldheight_m_actual','bouldcent','shadlen','shadlen_m')
+    #pixels in the mirrored shadow, not used
+    mpixels = None
+    #angle of the sun, fixed as coming from top (-y), this is holdover till
+    #code sentive to angle is entirely gone
+    beta = np.radians(270)
+    #placeholder for the patch object
+    ellipsepatch = None
+
+    def __init__(self, flag, pixels, im_area=None, context=None):
         #marker for this boulder, unique
         self.flag = flag
-        #immediate pixels in this shadow
-        self.pixels = pixels
-        #pixels in the mirrored shadow
-        self.mpixels = None
+        #immediate pixels in this shadow, nx2 array of [y,x]
+        self.pixels = np.asarray(pixels, dtype=np.int32).reshape(-1,2)
         #area of the shadow, based on how many pixels are in it
-        self.area = len(pixels)
-        #area for the mirrored shadow, simply 2*area for now, may change
-        self.marea = 2*self.area
-        #incedence angle of the sun, fixed by target image
-        self.inangle = INANGLE
-        #angle of the sun, fixed as coming from top (-y), this is holdover till
-        #code sentive to angle is entirely gone
-        self.beta = np.radians(270)
-        #image resolution, tied to each shadow image for safekeeping
-        self.resolution = RESOLUTION
-        #image area (pixels^2) tied to each shadow for safekeeping
-        self.im_area = im_area
+        self.area = len(self.pixels)
+        #incedence angle, resolution and image area are shared by the whole run
+        if context is None:
+            context = sharedcontext(INANGLE, RESOLUTION, im_area)
+        self.context = context
         #find the center of the shadow
-        tempx = 0.
-        tempy = 0.
-        for i in range(len(pixels)):
-            tempy +=pixels[i][0]
-            tempx +=pixels[i][1]
-        self.center = [tempy/float(len(pixels)),tempx/float(len(pixels))]
+        self.center = (self.pixels.sum(axis=0, dtype=np.int64)/float(self.area)).tolist()
         #border of the shadow
-        self.border = []
+        self.border = np.empty((0,2), dtype=int)
         #initially, the border of the shadow without the -y(upper) side,
         #finally the rim of the mirrored shadow
-        self.mborder = []
+        self.mborder = np.empty((0,2))
         #the flipping axis of the shadow
-        self.flipaxis = []
-        #initial conditions for the non Area-preserving and AP fits,
+        self.flipaxis = np.empty((0,2))
+        #initial conditions for the fit,
         #this gets overwritten in the run_prep section, leaving here for now
         self.fitinit = [self.center[0], 2.0,self.center[1], 2.0, 0.]
-        self.AP_fitinit = [self.center[0],2.0,self.center[1], 0.]
         #Empty variable, will be the return from the ODR fit
         self.fitbeta = None
         #Is the fit good assumed False, see ODRFit functions for conditions
@@ -937,107 +2034,106 @@ class shadow(object):
         #semi-axis along the sun direction in pixels and meters
         self.shadlen = None
         self.shadlen_m = None
-        #placeholder for the patch object
-        self.ellipsepatch = None
 
-    def run_prep(self):
+    #scene values live in the shared context, setting one gives this shadow its own context
+    @property
+    def inangle(self):
+        return self.context.inangle
+    @inangle.setter
+    def inangle(self, value):
+        self.context = sharedcontext(value, self.context.resolution, self.context.im_area)
+
+    @property
+    def resolution(self):
+        return self.context.resolution
+    @resolution.setter
+    def resolution(self, value):
+        self.context = sharedcontext(self.context.inangle, value, self.context.im_area)
+
+    @property
+    def im_area(self):
+        return self.context.im_area
+    @im_area.setter
+    def im_area(self, value):
+        self.context = sharedcontext(self.context.inangle, self.context.resolution, value)
+
+    @property
+    def marea(self):
+        #area for the mirrored shadow, simply 2*area for now, may change
+        return 2*self.area
+
+    def __setstate__(self, state):
+        #shadows pickled before __slots__ was used come with a plain attribute dictionary
+        if isinstance(state, tuple):
+            state = state[1]
+        else:
+            state = dict(state)
+            state['context'] = sharedcontext(state.pop('inangle',None), state.pop('resolution',None), state.pop('im_area',None))
+            state['pixels'] = np.asarray(state['pixels'], dtype=np.int32).reshape(-1,2)
+            for name, dtype in (('border',int),('mborder',float),('flipaxis',float)):
+                if state.get(name) is not None:
+                    state[name] = np.asarray(state[name], dtype=dtype).reshape(-1,2)
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
+        return
+
+    def lean(self):
+        #drop the border geometry and fit start once the shadow is measured, the fit results are all that is kept
+        self.border = None
+        self.mborder = None
+        self.flipaxis = None
+        self.fitinit = None
+        return
+
+    def run_prep(self, flags=None, warm=False):
         #main function that does most things we want it to do
+        #flags are the optional precomputed neighbor flags of the pixels, see borderflags
+        #warm starts the fit from the pixel moments (if WARMSTART), used for merge candidates
         
-        #self.findborder()
-        self.findborder_cents()
+        #self.findborder(flags)
+        self.findborder_cents(flags)
         if len(self.border) != 0:
             flipval = self.mirror()
             self.fitinit = [flipval, 2.0,self.center[1], 2.0, 0.]
+            if warm and WARMSTART:
+                self.fitinit = self.momentinit(flipval)
         
     def run_fit(self):
-        #to change the kind of border fit used, alter this line
-        if len(self.mborder)!=0:
-            self.odrfit_m()
+        #to change the kind of border fit used, set FITBACKEND
+        fitshadows([self])
 
     def run_post(self):
         #turned off this guard to see if large ones are being tossed
         #if self.fitgood:
         self.shadowmeasure_m()
+        if LEAN:
+            self.lean()
         
-    def findborder(self):
+    def findborder(self, flags=None):
         #we will look at each point and see if it has neighbors, if not, there is a border
-        #this cannot be the most efficient way to do this....
-    
-        for i in self.pixels:
-            top=False
-            other = False
-            if [i[0]-1,i[1]] not in self.pixels:
-                self.border+= [[i[0]-.5, i[1]]]
-                self.border+= [[i[0]-.5, i[1]+.5]]
-                self.flipaxis+= [[i[0]-.5, i[1]]]
-                self.flipaxis+= [[i[0]-.5, i[1]+.5]]
-                top = True
-                
-            if [i[0]+1,i[1]] not in self.pixels:
-                self.border+= [[i[0]+.5, i[1]]]
-                self.border+= [[i[0]+.5, i[1]-.5]]
-                self.mborder+= [[i[0]+.5, i[1]]]
-                self.mborder+= [[i[0]+.5, i[1]-.5]]
-                
-
-            if [i[0],i[1]+1] not in self.pixels:
-                self.border+= [[i[0], i[1]+.5]]
-                self.border+= [[i[0]+.5, i[1]+.5]]
-                if not top:
-                    self.mborder+= [[i[0], i[1]+.5]]
-                    self.mborder+= [[i[0]+.5, i[1]+.5]]
-                
+        #the neighbor search is done on a boolean mask, see shadowedges
+        #flags optionally carries the precomputed neighbor flags of the pixels (see borderflags)
+        self.border, self.mborder, self.flipaxis = shadowedges(self.pixels, flags)
+        return
 
-            if [i[0],i[1]-1] not in self.pixels:
-                self.border+= [[i[0], i[1]-.5]]
-                self.border+= [[i[0]-.5, i[1]-.5]]
-                if not top:
-                    self.mborder+= [[i[0], i[1]-.5]]
-                    self.mborder+= [[i[0]-.5, i[1]-.5]]
-    def findborder_cents(self):
+    def findborder_cents(self, flags=None):
         '''
         Alternate method for finding the shadow border, uses pixel cetners rather than pixel edges
         This may generally struggle with shadows that are linear
         must set self.border, self.mborder, self.flipaxis in otder to swap in for findborder
+        flags optionally carries the precomputed neighbor flags of the pixels (see borderflags)
         '''
 
         #quick check for linear shadows and small shadows, these need to be tossed
-        xs = [i[1] for i in self.pixels]
-        ys = [i[0] for i in self.pixels]
-        if min(xs) == max(xs) or min(ys) == max(ys):
+        low = self.pixels.min(axis=0)
+        high = self.pixels.max(axis=0)
+        if low[1] == high[1] or low[0] == high[0]:
             #this is a linear shadow, it will bomb the ODR fitting
             return
         if len(self.pixels) <=minA:
             #technicaly should have been filtered out earlier, but better safe than sorry
             return
-        for i in self.pixels:
-            top=False
-            other = False
-            bord = False
-            mirror = False
-            if [i[0]-1,i[1]] not in self.pixels:
-                self.border+= [i]
-                self.flipaxis+= [[i[0]-.5,i[1]]]
-                top = True
-                bord = True
-                
-            if [i[0]+1,i[1]] not in self.pixels:
-                self.mborder+= [i]
-                mirror = True
-                if not bord:
-                    self.border+= [i]
-                    
-            if [i[0],i[1]+1] not in self.pixels:
-                if not bord:
-                    self.border+= [i]
-                if not top and not mirror:
-                    self.mborder+= [i]
-                    
-            if [i[0],i[1]-1] not in self.pixels:
-                if not bord:
-                    self.border+= [i]
-                if not top and not mirror:
-                    self.mborder+= [i]
+        self.border, self.mborder, self.flipaxis = shadowborders(self.pixels, flags)
         return
         
     def mirror(self):
@@ -1048,54 +2144,70 @@ class shadow(object):
             pixel value, 
             '''
         #step 1, find the flip axis
-        yvals = np.array(self.flipaxis)
-        yvals = yvals[range(len(yvals)),[0]]
+        yvals = self.flipaxis[:,0]
         #this is the flip value
         #flipval = np.average(yvals)
         flipval = np.min(yvals)
-        self.mborder = [[float(k[0]),float(k[1])] for k in self.mborder]
+        self.mborder = np.asarray(self.mborder, dtype=float)
         #make a copy of the mborder, which lacks the -y boundary
         temp = np.copy(self.mborder)
-        dist = range(len(temp))
         #invert that about the flip value
-        temp[dist,[0]]*=-1
-        temp[dist,[0]]+=2*flipval
-        #mborder is stored as a list, lets keep it that way
-        temp = temp.tolist()
+        temp[:,0]*=-1
+        temp[:,0]+=2*flipval
         #append it and you are done
-        self.mborder+=temp
+        self.mborder = np.concatenate([self.mborder,temp])
         
         return flipval 
 
-    def odrfit_m(self):
-        input_y = list(map(lambda f:f[0], self.mborder))
-        input_x = list(map(lambda f:f[1], self.mborder))
-        input_dat = [input_y, input_x]
+    def momentinit(self, flipval):
+        '''fit starting point from the second moments of the shadow mirrored about flipval
+        the mirrored pixel set has no y-x covariance, so only the semi-axes are estimated,
+        a filled ellipse has a variance of a^2/4 along each axis'''
+        dy = self.pixels[:,0] - flipval
+        ay = 2*np.sqrt(np.mean(dy**2))
+        ax = 2*np.std(self.pixels[:,1])
+        return [flipval, max(ay,.5), self.center[1], max(ax,.5), 0.]
+
+    def odrfit_m(self, init=None):
+        #init optionally replaces fitinit as the starting point, e.g. a direct fit to polish
+        if init is None:
+            init = self.fitinit
+        input_dat = np.transpose(self.mborder)
         fit_data = odr.Data(input_dat, y=1)
-        fit_model = odr.Model(self.ellipse, implicit=True)
-        fit_odr = odr.ODR(fit_data, fit_model, self.fitinit)
+        fit_model = odr.Model(self.ellipse, fjacb=self.ellipse_jacb, fjacd=self.ellipse_jacd, implicit=True)
+        preset = ODRPRESETS[ODRPRESET]
+        fit_odr = odr.ODR(fit_data, fit_model, init, maxit=preset['maxit'], sstol=preset['sstol'], partol=preset['partol'])
+        #the jacobians are analytic, no need for ODRPACK to check them
+        fit_odr.set_job(deriv=3, var_calc=2)
         #print 'doing ODR'
         
         fit_out = fit_odr.run()
         
         #print 'ODR done'
-        self.fitinfo = str(fit_out.info)
+        self.setfit(fit_out.beta, fit_out.sum_square, str(fit_out.info))
+        return
+        #fit_out.pprint()
+
+    def setfit(self, beta, err, info):
+        #records a fit result, info is an ODR stopping condition, <4 is good, >4 is bad, 4 is OK
+        self.fitinfo = info
 
-        self.fitbeta = fit_out.beta
-        self.fiterr = fit_out.sum_square
+        self.fitbeta = np.asarray(beta, dtype=float)
+        self.fiterr = err
 
         area = abs(np.pi*self.fitbeta[1]*self.fitbeta[3])
         if area> MA:
             self.fitgood = False
         elif self.fitinfo == "2" or self.fitinfo == "3" or self.fitinfo == "1" or self.fitinfo == '4':
             self.fitgood = True
-        
+        else:
+            self.fitgood = False
         return
-        #fit_out.pprint()
         
     def shadowmeasure_m(self):
         '''shadow measuring now that we are doubling the shadow, very straightforward'''
-        if len(self.mborder) == 0:
+        #no fit was done because there was no mirrored border (a lean shadow has its border dropped)
+        if self.fitinfo is None and (self.mborder is None or len(self.mborder) == 0):
             self.bouldwid = mindist*2
             self.shadlen = 0
             self.bouldcent = self.center
@@ -1158,6 +2270,30 @@ class shadow(object):
         #print beta
         return val
 
+    def ellipse_jacb(self, beta, coords):
+        '''derivatives of ellipse with respect to beta, one row per parameter'''
+        yc, ay, xc, ax, alpha = beta
+        c = np.cos(alpha)
+        s = np.sin(alpha)
+        #rotated offsets, the ellipse is (p/ay)^2 + (q/ax)^2 - 1
+        p = (coords[0]-yc)*c + (coords[1]-xc)*s
+        q = (coords[1]-xc)*c - (coords[0]-yc)*s
+        return np.array([-2*p*c/ay**2 + 2*q*s/ax**2,
+                         -2*p**2/ay**3,
+                         -2*p*s/ay**2 - 2*q*c/ax**2,
+                         -2*q**2/ax**3,
+                         2*p*q/ay**2 - 2*p*q/ax**2])
+
+    def ellipse_jacd(self, beta, coords):
+        '''derivatives of ellipse with respect to the [y,x] coordinates'''
+        yc, ay, xc, ax, alpha = beta
+        c = np.cos(alpha)
+        s = np.sin(alpha)
+        p = (coords[0]-yc)*c + (coords[1]-xc)*s
+        q = (coords[1]-xc)*c - (coords[0]-yc)*s
+        return np.array([2*p*c/ay**2 - 2*q*s/ax**2,
+                         2*p*s/ay**2 + 2*q*c/ax**2])
+
     def patchplot(self,filt):
         #this will be the new ellipse plotting function that uses the matplotlib patches function
         #need to figure out how to make sure they are plotting correctly though...
@@ -1206,22 +2342,227 @@ def getshads(runfile, num, silenced = True, mode='rb'):
             print('Likely broken file')
         return None
     return load
-def bulkCFA(runfile,maxnum,maxd,fitmaxd,root):
+
+########Columnar Shadow Store##########
+#alternative to the pickled .shad stream, one .npy file per column in a {FNM}{num}_shadows.col folder
+#scalar columns: (name, dtype, width), missing values are NaN for floats and -1 for integers
+SHADCOLUMNS = [('flag',np.int64,1),('area',np.int64,1),('center',np.float64,2),('bouldcent',np.float64,2),
+               ('bouldwid',np.float64,1),('bouldheight',np.float64,1),('shadlen',np.float64,1),
+               ('bouldwid_m',np.float64,1),('bouldheight_m',np.float64,1),('shadlen_m',np.float64,1),
+               ('fitbeta',np.float64,5),('fiterr',np.float64,1),('fitinfo',np.int32,1),
+               ('measured',np.int8,1),('fitgood',np.int8,1),
+               ('inangle',np.float64,1),('resolution',np.float64,1),('im_area',np.int64,1)]
+#ragged columns: (name, dtype), stored as one (n,2) array plus a (shadows+1) offsets index
+SHADRAGGED = [('pixels',np.int32),('border',np.int32),('mborder',np.float32),('flipaxis',np.float32)]
+#also write the columnar store whenever shadows are saved
+SHADSTORE = False
+
+def shadstorepath(runfile, num):
+    return '%s%s%s%s_shadows.col'%(PATH,runfile,FNM,num)
+
+def shadfilekey(runfile, num):
+    #size and modification time of the .shad file, [-1,-1] if there is none
+    try:
+        stat = os.stat('%s%s%s%s_shadows.shad'%(PATH,runfile,FNM,num))
+    except(OSError):
+        return np.array([-1,-1], dtype=np.int64)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def shadvalue(value, dtype):
+    #convert a shadow attribute to its column value
+    if np.dtype(dtype).kind == 'f':
+        if value is None:
+            return np.nan
+        if isinstance(value, (float, int, np.number)) or np.ndim(value) == 0:
+            return float(value)
+        return np.array([np.nan if a is None else a for a in np.ravel(np.asarray(value, dtype=object))], dtype=float)
+    if value is None:
+        return -1
+    return int(value)
+
+def writeshadstore(runfile, num, shadows, source=None):
+    '''writes a list of shadow objects to the columnar store of a panel
+    source is the key of the .shad file the store was made from (see shadfilekey), a store
+    written without one is only used while there is no .shad file'''
+    path = shadstorepath(runfile, num)
+    temp = path+'.tmp'
+    if os.path.exists(temp):
+        shutil.rmtree(temp)
+    os.makedirs(temp)
+    n = len(shadows)
+    for name, dtype, width in SHADCOLUMNS:
+        col = np.empty((n,width) if width > 1 else n, dtype=dtype)
+        for i in range(n):
+            col[i] = shadvalue(getattr(shadows[i], name), dtype)
+        np.save(os.path.join(temp,name+'.npy'), col)
+    for name, dtype in SHADRAGGED:
+        parts = [np.asarray(getattr(a, name) if getattr(a, name) is not None else [], dtype=dtype).reshape(-1,2) for a in shadows]
+        offsets = np.zeros(n+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(a) for a in parts])
+        values = np.concatenate(parts) if n else np.empty((0,2), dtype=dtype)
+        np.save(os.path.join(temp,name+'.npy'), values)
+        np.save(os.path.join(temp,name+'_off.npy'), offsets)
+    if source is None:
+        source = np.array([-1,-1], dtype=np.int64)
+    np.save(os.path.join(temp,'source.npy'), source)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temp, path)
+    return path
+
+def readshadstore(runfile, num, columns=None, mmap=True):
+    '''reads columns of the columnar store of a panel, returns a dictionary of arrays or None
+    columns - names to load (see SHADCOLUMNS and SHADRAGGED), all if None, ragged columns
+              also bring their offsets as name_off
+    mmap - memory map the columns rather than reading them
+    a store older than the .shad file of the panel is ignored (None is returned)'''
+    path = shadstorepath(runfile, num)
+    try:
+        source = np.load(os.path.join(path,'source.npy'))
+    except(IOError):
+        return None
+    if not np.array_equal(source, shadfilekey(runfile, num)):
+        return None
+    if columns is None:
+        columns = [a[0] for a in SHADCOLUMNS]+[a[0] for a in SHADRAGGED]
+    ragged = [a[0] for a in SHADRAGGED]
+    mode = 'r' if mmap else None
+    store = {}
+    for name in columns:
+        store[name] = np.load(os.path.join(path,name+'.npy'), mmap_mode=mode)
+        if name in ragged:
+            store[name+'_off'] = np.load(os.path.join(path,name+'_off.npy'))
+    return store
+
+def shadrow(store, flag):
+    '''row of the shadow with a given flag in a store that has the flag column, None if missing
+    the sorted order of the flags is kept in the store (as flag_order) for the next lookup'''
+    order = store.get('flag_order')
+    if order is None:
+        order = np.argsort(store['flag'], kind='stable')
+        store['flag_order'] = order
+    i = np.searchsorted(store['flag'], flag, sorter=order)
+    if i < len(order) and store['flag'][order[i]] == flag:
+        return order[i]
+    return None
+
+def storeshadows(store, rows=None):
+    '''rebuilds shadow objects from a full store (see readshadstore), rows picks some of them'''
+    if rows is None:
+        rows = range(len(store['flag']))
+    shads = []
+    for i in rows:
+        pixels = store['pixels'][store['pixels_off'][i]:store['pixels_off'][i+1]]
+        context = sharedcontext(float(store['inangle'][i]), float(store['resolution'][i]), int(store['im_area'][i]))
+        shade = shadow(int(store['flag'][i]), pixels, context=context)
+        for name, dtype in SHADRAGGED[1:]:
+            part = store[name][store[name+'_off'][i]:store[name+'_off'][i+1]]
+            setattr(shade, name, part.astype(float if name != 'border' else int))
+        for name, dtype, width in SHADCOLUMNS:
+            if name in ('flag','area','inangle','resolution','im_area'):
+                #already set up by the constructor
+                continue
+            value = store[name][i]
+            if name in ('measured','fitinfo'):
+                value = None if value == -1 else (str(value) if name == 'fitinfo' else bool(value))
+            elif name == 'fitgood':
+                value = bool(value)
+            elif width > 1:
+                if name == 'fitbeta' and np.all(np.isnan(value)):
+                    value = None
+                elif name == 'fitbeta':
+                    value = np.array(value)
+                else:
+                    value = [None if np.isnan(a) else float(a) for a in value]
+            else:
+                value = None if np.isnan(value) else float(value)
+            setattr(shade, name, value)
+        shads+=[shade]
+    return shads
+
+def convertshads(runfile, num):
+    '''converts the pickled .shad file of a panel to the columnar store, returns the store path or None'''
+    load = getshads(runfile,num)
+    if load == None:
+        return None
+    shads = []
+    while True:
+        try:
+            shads+=[pickle.load(load)]
+        except(EOFError):
+            break
+    load.close()
+    return writeshadstore(runfile, num, shads, shadfilekey(runfile, num))
+
+def loadshadows(runfile, num):
+    '''all the shadow objects of a panel, from the columnar store if it is current, otherwise
+    from the .shad file. returns None if neither exists'''
+    store = readshadstore(runfile, num)
+    if store is not None:
+        return storeshadows(store)
+    load = getshads(runfile,num)
+    if load == None:
+        return None
+    shads = []
+    while True:
+        try:
+            shads+=[pickle.load(load)]
+        except(EOFError):
+            break
+    load.close()
+    return shads
+
+def shadcolumns(runfile, num, columns):
+    '''just some columns of the shadows of a panel, as a dictionary of arrays (see SHADCOLUMNS)
+    read from the columnar store when there is a current one, else gathered from the .shad file'''
+    store = readshadstore(runfile, num, columns)
+    if store is not None:
+        return store
+    shads = loadshadows(runfile, num)
+    if shads is None:
+        return None
+    kinds = dict((a[0],a[1:]) for a in SHADCOLUMNS)
+    store = {}
+    for name in columns:
+        dtype, width = kinds[name]
+        col = np.empty((len(shads),width) if width > 1 else len(shads), dtype=dtype)
+        for i in range(len(shads)):
+            col[i] = shadvalue(getattr(shads[i], name), dtype)
+        store[name] = col
+    return store
+
+def saveshadows(runfile, num, shadows):
+    '''writes a panel's shadows to its .shad file, and to the columnar store if SHADSTORE is set
+    or the panel already has a store'''
+    save = getshads(runfile,num,mode='wb')
+    for shade in shadows:
+        pickle.dump(shade,save)
+    save.close()
+    if SHADSTORE or os.path.exists(shadstorepath(runfile, num)):
+        writeshadstore(runfile, num, shadows, shadfilekey(runfile, num))
+    return
+
+def bulkCFA(runfile,maxnum,maxd,fitmaxd,root,new=None,refs=None,workers=None):
     ''' runs the CFA protocol on a bunch of files and gives an average
+    new - 'y' recomputes the CFA of every panel, 'n' reads the CFA csv files already saved,
+          'auto' reuses the cached CFAs and recomputes only the panels whose shadows changed, None asks
+    refs - which reference curves to plot, see plotCFArefs, None asks
+    workers - number of processes the panel CFAs are computed in, defaults to the number of cores
 '''
     #set value for maximum on plots (in meters)
     plotmax = 3
-    while True:
+    while new is None:
         new = raw_input('make new CDFs? y/n\n')
-        if new == 'y' or new == 'n':
-            break
+        if new != 'y' and new != 'n':
+            new = None
     allCFAs = []
     if new == 'n':
         for i in range(maxnum):
             try:
                 data = open('%s%s%s%s_CFA.csv'%(PATH,runfile,FNM,i),'r')
-                dat = np.loadtxt(data,delimiter=',')
-                
+                #saved as one row per bin, back to [bins, CFA, CFAsigma]
+                dat = np.transpose(np.loadtxt(data,delimiter=','))
+                data.close()
             except(IOError):
                 continue
 
@@ -1229,57 +2570,24 @@ def bulkCFA(runfile,maxnum,maxd,fitmaxd,root):
         if allCFAs == []:
             print ("No CDFs Present")
             new = 'y'
-    if new == 'y':
-        for i in range(maxnum):
-            #acuire all the CFA data, this will come in the form:
-            #CFA[0] = bins
-            #CFA[1] = lower error bound CFA
-            #[2] = actual CFA data
-            #[3] = Upper bound error CFA
-            dat = CFA(runfile,i, maxd)
-            #Keep an eye on this, would break quickly if CFA is changed
-            if len(dat) == 3:
-                #plt.plot(dat[0],dat[2],'b-',alpha=.05)
-                allCFAs+=[dat]
-                #print len(dat)
-
-##    if not any(allCFAs):
-##        return None, None
-    #extract bins and the three CFAs (upCFAs = upper end of CFA uncertainty, downCFAs lower end of uncertainty)
-    #above method is being revised, shifting to a sigma calculation
+    if new == 'y' or new == 'auto':
+        #CFA[0] = bins, CFA[1] = CFA, CFA[2] = CFA sigma
+        allCFAs = panelCFAs(runfile, maxnum, maxd, workers, force=(new == 'y'))[0]
+    if len(allCFAs) == 0:
+        LOG.warning("No CFAs for %s", runfile)
+        return None
+
+    #average accross panels in one go, the arrays are (image,bins)
+    #also fetch a 25% and 75% CFA curve, the sigmas combine in quadrature
+    allCFAs = np.asarray(allCFAs)
     bins = allCFAs[0][0]
-    allCFAs = np.array(allCFAs)
-    #CFAs = allCFAs[:,2]
-    #upCFAs = allCFAs[:,1]
-    #downCFAs = allCFAs[:,3]
     CFAs = allCFAs[:,1]
     CFAsigmas = allCFAs[:,2]
-    #tranpose the files to go from (image,bins) to (bins,image) format
-    T_CFAs = np.transpose(CFAs)
-    T_CFAsigmas = np.transpose(CFAsigmas)
-    #T_upCFAs = np.transpose(upCFAs)
-    #T_downCFAs = np.transpose(downCFAs)
-    #average accross bins, results in 1-D array of length 'bins'
-    #also fetch a 25% and 75% CFA curve
-    avgCFAs = list(map(np.average, T_CFAs))
-    topqCFAs = list(map(lambda x: np.percentile(x, 75), T_CFAs))
-    botqCFAs = list(map(lambda x: np.percentile(x, 25), T_CFAs))
-    avgCFAsigmas = []
-    
-    for i in T_CFAsigmas:
-        sigma = (1/float(len(i)))*(np.sqrt(sum(map(lambda x: x**2,i))))
-        avgCFAsigmas+=[sigma]
-    avgupCFAs = []
-    avgdownCFAs = []
-    for i in range(len(avgCFAs)):
-        avgupCFAs+=[avgCFAs[i]+avgCFAsigmas[i]]
-        avgdownCFAs+=[avgCFAs[i]-avgCFAsigmas[i]]
-    #avgupCFAs = map(np.average,T_upCFAs)
-    #avgdownCFAs = map(np.average,T_downCFAs)
-##    print bins
-##    print CFAs
-##    print upCFAs
-##    print downCFAs
+    avgCFAs = np.average(CFAs, axis=0)
+    topqCFAs, botqCFAs = np.percentile(CFAs, [75,25], axis=0)
+    avgCFAsigmas = np.sqrt(np.sum(CFAsigmas**2, axis=0))/float(len(CFAsigmas))
+    avgupCFAs = avgCFAs+avgCFAsigmas
+    avgdownCFAs = avgCFAs-avgCFAsigmas
     #fit to each end of the spectrum
     fit_k, fit_r2 = fittoRA(bins,avgCFAs, [0.4,fitmaxd])
     #upfit_k, upfit_r2 = fittoRA(bins,avgupCFAs, [1.5,maxd])
@@ -1308,7 +2616,7 @@ def bulkCFA(runfile,maxnum,maxd,fitmaxd,root):
     plt.errorbar(fit_bins,fitRA,zorder=2,label = 'RA Envelope',yerr = errors,ecolor = 'k',c = 'k',marker='|',alpha=.5)
     plt.plot(fit_bins,topqfitRA,zorder=3,label = '75th Percentile RA')
     plt.plot(fit_bins,botqfitRA,zorder=3,label = '25th Percentile RA')
-    plotCFArefs(plotmax)
+    plotCFArefs(plotmax, refs)
     plt.xscale('log')
     plt.yscale('log')
     plt.xlim(xmin= 0.4, xmax=plotmax) #changes x min to smallest detected boulder
@@ -1361,76 +2669,91 @@ def bulkCFA(runfile,maxnum,maxd,fitmaxd,root):
 import numpy as np
 import pickle
 
-def CFA(runfile, num, maxd):
+def panelCFAs(runfile, maxnum, maxd, workers=None, force=False):
+    '''CFA results of panels 0 to maxnum-1 as an (panels,3,bins) array of [bins, CFA, CFAsigma],
+    along with the numbers of the panels that had them
+    results are cached in CFAcache_maxd_{maxd}.npz in the runfile folder, keyed on each panel's .shad file,
+    only panels that are new or whose shadows changed (all of them if force) are recomputed,
+    in parallel worker processes
+    '''
+    cachefile = '%s%sCFAcache_maxd_%s.npz'%(PATH,runfile,maxd)
+    nbins = len(np.linspace(0, maxd, 20 * maxd + 1))
+    keys = np.array([shadfilekey(runfile,i) for i in range(maxnum)], dtype=np.int64).reshape(-1,2)
+    cfas = np.zeros((maxnum,3,nbins))
+    have = np.zeros(maxnum, dtype=bool)
+    done = np.zeros(maxnum, dtype=bool)
+    if not force:
+        try:
+            saved = np.load(cachefile)
+            n = min(maxnum, len(saved['keys']))
+            fresh = np.all(saved['keys'][:n] == keys[:n], axis=1)
+            cfas[:n][fresh] = saved['cfas'][:n][fresh]
+            have[:n][fresh] = saved['have'][:n][fresh]
+            done[:n] = fresh
+        except(IOError, KeyError, ValueError):
+            pass
+    todo = np.flatnonzero(~done)
+    if len(todo):
+        LOG.info("Computing CFAs for %s panels", len(todo))
+        config = runconfig(None)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(panelCFA, [runfile]*len(todo), todo, [maxd]*len(todo), [config]*len(todo),
+                               chunksize=max(1,len(todo)//(8*(os.cpu_count() or 1))))
+            for i, dat in zip(todo, results):
+                if len(dat) == 3:
+                    cfas[i] = dat
+                    have[i] = True
+        try:
+            np.savez(cachefile, keys=keys, cfas=cfas, have=have)
+        except(IOError):
+            pass
+    return cfas[have], np.flatnonzero(have)
+
+def panelCFA(runfile, num, maxd, config):
+    #CFA of one panel in a worker process, see panelCFAs
+    config.apply()
+    return CFA(runfile, num, maxd)
+
+def CFA(runfile, num, maxd, sizes=None, res=None, im_area=None):
     # Produces data for Cumulative Fractional Area, saves and produces plot
     # plt.show must be called after to plot all the data
-    load = getshads(runfile, num)
-    sizes = []
-    if not load:
-        print("Failed to load shadow data.")
-        return [None]
-    # Print to ensure the file is being read
-    print(f"File {load.name} opened successfully.")
-    while True:
+    #sizes optionally gives the measured boulder diameters (m) directly, the shadows are then not read,
+    #res and im_area go with them, if not given they are read from the panel
+    #progress goes to the MBARS logger, debug level shows the diameters and the full arrays
+    if sizes is None:
+        #only the columns needed are read, straight from the columnar store if there is one
         try:
-            dat = pickle.load(load)
-        except EOFError:
-            break
+            cols = shadcolumns(runfile, num, ['measured','bouldwid_m','resolution','im_area'])
         except Exception as e:
-            print(f"Error loading data from shadow file: {e}")
-            break
-        
-        if isinstance(dat, shadow) and dat.measured:
-            sizes.append(dat.bouldwid_m)
-            print(f"Boulder Width (meters): {dat.bouldwid_m}")  # Print each boulder width
-            res = dat.resolution
-            im_area = dat.im_area
-    if not sizes:
-        print("No sizes collected. Exiting function.")
-        return [None]
-    
-    print(f"Sizes collected: {sizes}")
-    err = 1
-    sigma = err * res
-    sizes = np.asarray(sizes)
-    sizes = [x for x in sizes if x < maxd]
-    sizes = np.asarray(sizes)
-    print(f"Sizes after filtering (maxd={maxd}): {sizes}")
-    
-    #create histogram bins
-    bins = np.linspace(0, maxd, 20 * maxd + 1)
-    
-    #calculate SFD
-    SFD, binsconf = np.histogram(sizes, bins=bins)
-    SFD = SFD / im_area
-    sizes.sort()
-
-    # Print histogram and SFD details
-    print(f"Bins: {bins}")
-    print(f"Image Area: {im_area}")
-    print(f"Resolution: {res}")
-    print(f"SFD: {SFD}")
-    
-    # Initialize CFA and CFAsigma arrays
-    if len(bins) > 0:
-        CFA = np.zeros_like(bins, dtype=float)
-        CFAsigma = np.zeros_like(bins, dtype=float)
-    else:
-        print("Bins array is empty. Exiting function.")
+            LOG.error("Error loading data from shadow file: %s", e)
+            cols = None
+        if not cols:
+            LOG.warning("Failed to load shadow data.")
+            return [None]
+        LOG.info("Shadow data for %s%s opened successfully.", FNM, num)
+        measured = np.flatnonzero(cols['measured'] == 1)
+        sizes = cols['bouldwid_m'][measured]
+        if len(measured):
+            res = cols['resolution'][measured[-1]]
+            im_area = cols['im_area'][measured[-1]]
+    elif res is None or im_area is None:
+        cols = shadcolumns(runfile, num, ['resolution','im_area'])
+        if not cols or len(cols['resolution']) == 0:
+            LOG.warning("Failed to load shadow data.")
+            return [None]
+        res = cols['resolution'][-1]
+        im_area = cols['im_area'][-1]
+    sizes = np.asarray(sizes, dtype=float)
+    if len(sizes) == 0:
+        LOG.info("No sizes collected. Exiting function.")
         return [None]
-
-    for i in range(len(bins)):
-        # Compute CFA values
-        filtered_sizes = sizes[sizes > bins[i]]
-        areas = np.pi * (filtered_sizes / 2) ** 2
-        CFA[i] = float(np.sum(areas)) / im_area
-        
-        # Compute CFAsigma values
-        CFAsigma[i] = sigma * np.sqrt((np.pi / im_area) * CFA[i])
-        
-    # Print CFA and CFAsigma details
-    print(f"CFA: {CFA}")
-    print(f"CFAsigma: {CFAsigma}")
+    LOG.debug("Boulder widths (meters): %s", sizes)
+    bins, CFA, CFAsigma, binsconf, SFD = cfacurve(sizes, maxd, res, im_area)
+    LOG.debug("Bins: %s", bins)
+    LOG.debug("Image Area: %s, Resolution: %s", im_area, res)
+    LOG.debug("SFD: %s", SFD)
+    LOG.debug("CFA: %s", CFA)
+    LOG.debug("CFAsigma: %s", CFAsigma)
     
     #Original save paths
 #     # Save results to CSV files
@@ -1461,11 +2784,33 @@ def CFA(runfile, num, maxd):
     return [bins, CFA.tolist(), CFAsigma.tolist()]
 
 
-def plotCFArefs(xmax):
+def cfacurve(sizes, maxd, res, im_area, err=1):
+    '''cumulative fractional area of a set of boulder diameters (m), diameters of maxd or more are dropped
+    bins are every 0.05 m from 0 to maxd, CFA[i] is the area of the boulders wider than bins[i] over im_area,
+    with the uncertainty of an err pixel diameter error, the SFD is the histogram over the same bins
+    returns bins, CFA, CFAsigma, the SFD bin edges and the SFD
+    '''
+    sigma = err * res
+    sizes = np.sort(np.asarray(sizes, dtype=float))
+    sizes = sizes[:np.searchsorted(sizes, maxd, side='left')]
+    #create histogram bins
+    bins = np.linspace(0, maxd, 20 * maxd + 1)
+    SFD, binsconf = np.histogram(sizes, bins=bins)
+    SFD = SFD / im_area
+    #area of every boulder from the largest down, so a suffix sum is the area above any size
+    areas = np.pi * (sizes / 2) ** 2
+    above = np.concatenate([np.cumsum(areas[::-1])[::-1], [0.]])
+    CFA = above[np.searchsorted(sizes, bins, side='right')] / im_area
+    CFAsigma = sigma * np.sqrt((np.pi / im_area) * CFA)
+    return bins, CFA, CFAsigma, binsconf, SFD
+
+def plotCFArefs(xmax, option=None):
     ''' plots data from golombek 2008 for comparison, user controlled which one
+    option is asked for if it is not given, 0 plots none
 '''
     query = 'Plot: 1= just reference \n 2= just TRA_000828_2495 \n 3=Sholes PSP_007718_2350 Hand Counts \n 5=all\n'
-    option = int(raw_input(query))
+    if option is None:
+        option = int(raw_input(query))
     if option == 1 or option == 5:
         #dat = np.loadtxt('%sGolomRefCFACurves.csv'%(REFPATH),delimiter=',')
         xs = np.linspace(.1,xmax)
@@ -1524,13 +2869,8 @@ def fittoRA(xdat,ydat,RNG = [0.4,2.25]):#changed to 0.4 from 1.5 (min detected b
 
 def checkbads(runfile,num):
     #this is for when you want to get all the shadows that went awry and plot them
-    load = getshads(runfile,num)
     bads = []
-    while True:
-        try:
-            dat = pickle.load(load)
-        except EOFError:
-            break
+    for dat in loadshadows(runfile,num):
         if not dat.measured:
             bads+=[dat]
             
@@ -1557,7 +2897,7 @@ def checkbads(runfile,num):
     
     fig=plt.figure(1)
     ax = fig.add_subplot(111)
-    image = np.load('%s%s%s%s_rot_masked.npy'%(PATH, runfile,FNM, num))
+    image = npma.masked_equal(rotatedpanel(runfile,num), 0)
     
     plt.imshow(image, cmap='binary_r')
     for j in patches:
@@ -1569,26 +2909,20 @@ def checkbads(runfile,num):
     
 def ExamineImage(runfile,num, showblanks,filt = True):
     hasshads = True
+    geometry()
 
     if hasshads:
-        load = getshads(runfile,num)
         #need two so you dont reuse same artist, silly but necessary
         patches1 = []
         patches2 = []
-        while True:
-            try:
-                dat = pickle.load(load)
-            except EOFError:
-                break
+        for dat in loadshadows(runfile,num):
             patches1 += dat.patchplot(filt)
             patches2 +=dat.patchplot(filt)
         #image = np.load('%s%s%s%s_rot_masked.npy'%(PATH,runfile,FNM,num))
-        image = imageio.imread('%s%s%s.PNG'%(PATH,FNM,num))
-        segimage = np.load('%s%s%s%s_SEG.npy'%(PATH,runfile,FNM,num),allow_pickle=True)
-        image = sktrans.rotate(image,ROTANG, resize=True, preserve_range=True)
+        image = npma.masked_equal(rotatedpanel(runfile,num), 0)
+        segimage = loadlabels(labelpath(runfile,num,'SEG'))
         #segimage = sktrans.rotate(segimage,ROTANG, resize=True, preserve_range=True)
-        image = npma.masked_equal(image, 0)
-        filtimage = np.load('%s%s%s%s_flagged.npy'%(PATH,runfile,FNM,num),allow_pickle=True)
+        filtimage = loadlabels(labelpath(runfile,num,'flagged'))
         
         fig,ax = plt.subplots(2,2,sharex = True, sharey = True, figsize=(30,30))
         ax[0][0].imshow(image, cmap='binary_r', interpolation='none')
@@ -1621,7 +2955,7 @@ def ExamineImage(runfile,num, showblanks,filt = True):
         image = imageio.imread('%s%s//%s%s.PNG'%(PATH,FNM,FNM,num))
         image = sktrans.rotate(image,ROTANG, resize=True, preserve_range=True)
         image = npma.masked_equal(image, 0)
-        filtimage = np.load('%s%s//%s%s%s_flagged.npy'%(PATH,FNM,runfile,FNM,num),allow_pickle=True)
+        filtimage = loadlabels('%s%s//%s%s%s_flagged.npz'%(PATH,FNM,runfile,FNM,num))
         fig,ax = plt.subplots(2,2,sharex = True, sharey = True)
         ax[0][0].imshow(image, cmap='binary_r', interpolation='none')
         ax[0][1].imshow(image,cmap='binary_r',interpolation='none')
@@ -1633,16 +2967,10 @@ def ExamineImage(runfile,num, showblanks,filt = True):
         
 def FindBigs(runfile,num,diam = 3):
     '''code to find and identify large boulders thay may be causing issues in the CFA'''
-    shads = []
-    load = getshads(runfile,num)
-    if load == None:
+    geometry()
+    shads = loadshadows(runfile,num)
+    if shads == None:
         return None
-    while True:
-        try:
-            dat = pickle.load(load)
-            shads+=[dat]
-        except(EOFError):
-            break
     bigs = []
     patches = []
     total = 0
@@ -1658,9 +2986,7 @@ def FindBigs(runfile,num,diam = 3):
     tossout = float(len(bigs)/total)
     #image = np.load('%s%s%s%s_rot_masked.npy'%(PATH,runfile,FNM,num))
     #replacing this with the original image to save on drive space.
-    image = imageio.imread('%s%s%s.PNG'%(PATH,FNM,num))
-    image = sktrans.rotate(image,ROTANG, resize=True, preserve_range=True)
-    image = npma.masked_equal(image, 0) 
+    image = npma.masked_equal(rotatedpanel(runfile,num), 0)
     fig,ax = plt.subplots(1,2, sharex = True, sharey = True)
     ax[0].imshow(image,cmap='binary_r',interpolation='none')
     ax[1].imshow(image,cmap='binary_r',interpolation='none')
@@ -1672,21 +2998,12 @@ def FindExcluded(runfile,maxnum,maxdiam):
     total = np.long(0)
     used = np.long(0)
     for i in range(maxnum):
-        shads = []
-        load = getshads(runfile,i)
-        if load == None:
+        cols = shadcolumns(runfile,i,['measured','bouldwid_m'])
+        if cols == None:
             continue
-        while True:
-            try:
-                dat = pickle.load(load)
-                shads+=[dat]
-            except(EOFError):
-                break
-        for j in shads:
-            if j.measured:
-                total+=1
-                if j.bouldwid_m<maxdiam:
-                    used+=1
+        measured = cols['measured'] == 1
+        total+=np.count_nonzero(measured)
+        used+=np.count_nonzero(measured & (cols['bouldwid_m']<maxdiam))
     exclpercent = 100.*(float(total-used)/float(total))
     print ('%s boulders found in image, %s percent ignored due to diameter'%(total,exclpercent))
     return
@@ -1695,51 +3012,40 @@ def ManualMerge(runfile,num,flags):
     '''Code to manually merge two boulders, only to be used in exception circumstances
         runfile and num specify the image, boulders listed in flags will be merged into one with lowest flag value.
         '''
-    shads = getshads(runfile,num,mode = 'rb')
     boulds=[]
     mergeboulds = []
-    while True:
-        try:
-            dat = pickle.load(shads)
-        except(EOFError):
-            break
+    for dat in loadshadows(runfile,num):
         if dat.flag in flags:
             mergeboulds += [dat]
         else:
             boulds+=[dat]
     print (len(mergeboulds))
-    shads.close()
-    shads = getshads(runfile,num,mode='wb')
-    for obj in boulds:
-        pickle.dump(obj,shads)
     if len(mergeboulds) == len(flags):
         finalflag = mergeboulds[0].flag
-        finalarea = mergeboulds[0].im_area
         finalpixels = []
         for i in mergeboulds:
-            finalpixels+=i.pixels
+            finalpixels+=[i.pixels]
+        finalpixels = np.concatenate(finalpixels)
         
-        newbould=shadow(finalflag, finalpixels, finalarea)
-        newbould.run_prep()                  
+        #the merged shadow keeps the scene values of the ones it is made from, the globals may not be set up
+        newbould=shadow(finalflag, finalpixels, context=mergeboulds[0].context)
+        newbould.run_prep(warm=True)                  
         newbould.run_fit()
         newbould.run_post()
-        pickle.dump(newbould,shads)
-        shads.close
+        saveshadows(runfile,num,boulds+[newbould])
         print ('succesfully merged input boulders with flags %s'%(flags))
         return
 
     else:
         print('Did not find %s boulders, aborting merge'%(len(flags)))
-        for obj in mergeboulds:
-            pickle.dump(obj,shads)
-        shads.close()
+        saveshadows(runfile,num,boulds+mergeboulds)
         return
         
     
     
 ##Very important##
 #Looks like dlow and dhigh are not used??
-def OutToGIS(runfile,writefile,maxnum,dlow = 1.0, dhigh = 5,extension='.PGw'):
+def OutToGIS(runfile,writefile,maxnum,dlow = 1.0, dhigh = 5,extension='.PGw',workers=None):
     '''this code will take an entire run and export the boulder data to a GIS-interpretable format, assume pngs for the moment'''
     ''' A key part of this is interpreting the PGW files, which follow this convention:
         6 values on 6 lines:
@@ -1752,6 +3058,8 @@ def OutToGIS(runfile,writefile,maxnum,dlow = 1.0, dhigh = 5,extension='.PGw'):
         these are inputs to two equations for xmap and ymap, the coordinates of the pixel in the map, based on x and y, the pixel coordinates of the image:
         xmap = Ax + By +C
         ymap = Dx + Ey +F
+        the panel shapes and world files come from the scene geometry table (see panelgeometry),
+        panels are converted in parallel in workers processes and written in panel order
     '''
     if not os.path.exists('%sGISFiles//%s'%(PATH,writefile)):
         os.makedirs('%sGISFiles//%s'%(PATH,writefile))
@@ -1762,96 +3070,168 @@ def OutToGIS(runfile,writefile,maxnum,dlow = 1.0, dhigh = 5,extension='.PGw'):
     datafile.write(headers)
     datafile2.write(headers)
     #bring in the original rotation information
-    rotang_r = np.radians(ROTANG)
-    for i in range(maxnum+1):
-        #bring in the image each time, wouldnt have to do this if they were all identical
-        #but that cant be gauranteed
-        try:
-            seg = np.load('%s%s%s%s_flagged.npy'%(PATH,runfile,FNM,i),allow_pickle = True)
-        except(IOError):
-            continue
-        shads = getshads(runfile,i)
-        if not shads:
-            print('no shads for %s\n'%(i))
-            continue
-        lycent = len(seg)/2.
-        lxcent = len(seg[0])/2.
-        seg = None
-        o_image = imageio.imread('%s%s%s.PNG'%(PATH,FNM,i))
-        o_lycent = len(o_image)/2.
-        o_lxcent = len(o_image[0])/2.
-        o_image = None
-        
-        worldfile = open('%s%s%s%s'%(PATH,FNM,i,extension),'r')
-        constants = []
-        for line in worldfile:
-            val = float(line.rstrip())
-            constants+=[val]
-        boulds = []
-        marks = []
-        while True:
-            try:
-                dat  = pickle.load(shads)
-            except:
-                break
-            #taking out the filter for now to see if good ones are getting tossed
-            try:
-                flag = dat.flag
-                bouldwid_m = dat.bouldwid_m
-                bouldheight_m = dat.bouldheight_m
-                shadlen = dat.shadlen
-                AR = float(bouldheight_m/bouldwid_m)
-                angle = dat.fitbeta[4]
-                try:
-                    fiterr = dat.fiterr
-                except:
-                    fiterr = None
-                #GIS doesnt like mixing data types in csv
-                measured = int(dat.measured)
-                fitgood = int(dat.fitgood)
-                #weve got to do something a little tricky here, we need the pixel location of the boulders in the un-rotated images
-                #first we make a pointmap with flags to keep track
-                #boulds+=[dat]
-               
-                xpos = dat.bouldcent[1]
-                ypos = dat.bouldcent[0]
-            except:
-                print ("failed to retrieve parameters")
-                continue
-                #change xpos and ypos to origin on the image center
-            xpos_c = xpos-lxcent
-            ypos_c = ypos-lycent
-
-            #rotate them, must give the negative rotation
-            xpos_rot_c = xpos_c*np.cos(rotang_r) - ypos_c*np.sin(rotang_r)
-            ypos_rot_c = xpos_c*np.sin(rotang_r) + ypos_c*np.cos(rotang_r)
-
-            #re-reference to the corner of the image
-            xpos_rot = xpos_rot_c + o_lxcent
-            ypos_rot = ypos_rot_c + o_lycent
-            xmap = constants[0]*xpos_rot + constants[2]*ypos_rot + constants[4]
-            ymap = constants[1]*xpos_rot + constants[3]*ypos_rot + constants[5]
-            #write it all down
-            info = '%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n'%(i,flag,xmap,ymap,bouldwid_m,bouldheight_m,shadlen,measured,fitgood,fiterr,angle)
-            datafile.write(info)
-            #putting the aspect ratio filter in here, going to use numbers based on Demidov and Basilevsky 2014
-            #average = ~.5
-            #stdev = ~.28
-            #low boundary = .22
-            #high boundary = .78
-            if shadlen!=0 and bouldwid_m<20 and fitgood == 1:
-                datafile2.write(info)
-                
-                
-        shads.close()           
+    geometry()
+    geom = panelgeometry(runfile, maxnum, extension)
+    panels = [i for i in range(maxnum+1) if not np.isnan(geom['shape'][i,0])]
+    config = runconfig(None)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = pool.map(gisrows, [runfile]*len(panels), panels, [dict((a,geom[a][i]) for a in geom) for i in panels],
+                        [extension]*len(panels), [config]*len(panels))
+        for allrows, cleanrows in rows:
+            datafile.write(allrows)
+            datafile2.write(cleanrows)
+
     datafile.close()
     datafile2.close()
     return
-            
-        
-        
-            
-    
+
+def gisrows(runfile, num, geom, extension, config):
+    '''the OutToGIS rows of one panel, all the boulders and the clean ones, as two blocks of text
+    geom is the panel's row of the scene geometry table'''
+    config.apply()
+    cols = shadcolumns(runfile, num, ['flag','bouldwid_m','bouldheight_m','shadlen','measured','fitgood',
+                                      'fiterr','fitbeta','bouldcent'])
+    if cols is None:
+        #panel never got as far as detection
+        return '', ''
+    if len(cols['flag']) == 0:
+        print('no shads for %s\n'%(num))
+        return '', ''
+    constants = geom['world']
+    if np.any(np.isnan(constants)):
+        constants = worldfile(num, extension)
+    #shadows missing any of the parameters are left out
+    keep = ~(np.isnan(cols['bouldwid_m']) | np.isnan(cols['bouldheight_m']) | np.isnan(cols['fitbeta'][:,4]) |
+             np.isnan(cols['bouldcent']).any(axis=1) | (cols['measured'] < 0) | (cols['fitgood'] < 0))
+    for i in range(np.sum(~keep)):
+        print ("failed to retrieve parameters")
+    #we need the pixel location of the boulders in the un-rotated images
+    pos = unrotate(cols['bouldcent'][keep], geom['affine'])
+    ypos_rot = pos[:,0]
+    xpos_rot = pos[:,1]
+    xmap = constants[0]*xpos_rot + constants[2]*ypos_rot + constants[4]
+    ymap = constants[1]*xpos_rot + constants[3]*ypos_rot + constants[5]
+    #GIS doesnt like mixing data types in csv, missing values are written as None
+    def column(values):
+        return [None if a != a else a for a in values.tolist()]
+    shadlen = column(cols['shadlen'][keep])
+    fields = zip(cols['flag'][keep].tolist(), xmap.tolist(), ymap.tolist(), cols['bouldwid_m'][keep].tolist(),
+                 cols['bouldheight_m'][keep].tolist(), shadlen, cols['measured'][keep].tolist(),
+                 cols['fitgood'][keep].tolist(), column(cols['fiterr'][keep]), cols['fitbeta'][keep,4].tolist())
+    rows = ['%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n'%((num,)+row) for row in fields]
+    #putting the aspect ratio filter in here, going to use numbers based on Demidov and Basilevsky 2014
+    #average = ~.5
+    #stdev = ~.28
+    #low boundary = .22
+    #high boundary = .78
+    clean = (np.array([a != 0 for a in shadlen], dtype=bool) & (cols['bouldwid_m'][keep] < 20) &
+             (cols['fitgood'][keep] == 1))
+    return ''.join(rows), ''.join([rows[i] for i in np.flatnonzero(clean)])
+
+######Scene Geometry###########
+#one row per panel: rotated shape (y,x), original shape (y,x), the six world file values
+#(A,D,B,E,C,F, NaN if there is no world file), ROTANG, the affine from rotated to original pixels
+#(a,b,c,d,e,f: x = a*xrot + b*yrot + c, y = d*xrot + e*yrot + f) and the panel source (see panelsource),
+#recorded by rotatedpanel
+GEOMCOLS = 23
+
+def geometrypath(runfile, num):
+    return '%s%s%s%s_geometry.npy'%(PATH,runfile,FNM,num)
+
+def panelrotation(oshape, rotang):
+    '''the transform sktrans.rotate(image, rotang, resize=True) warps with, for an image of shape oshape,
+    returns it (a 3x3 matrix taking rotated [x,y,1] to original pixels) and the rotated shape'''
+    rows, cols = oshape[0], oshape[1]
+    center = np.array((cols, rows)) / 2. - 0.5
+    tform = (sktrans.SimilarityTransform(translation=-center) + sktrans.SimilarityTransform(rotation=np.deg2rad(rotang))
+             + sktrans.SimilarityTransform(translation=center))
+    corners = tform.inverse(np.array([[0, 0], [0, rows - 1], [cols - 1, rows - 1], [cols - 1, 0]]))
+    mins = corners.min(axis=0)
+    shape = np.around((corners[:,1].max() - mins[1] + 1, corners[:,0].max() - mins[0] + 1))
+    tform = sktrans.SimilarityTransform(translation=mins) + tform
+    matrix = tform.params.copy()
+    matrix[2] = (0, 0, 1)
+    return matrix, (int(shape[0]), int(shape[1]))
+
+def unrotate(points, affine):
+    '''[y,x] pixel positions in a panel rotated by autobound back to the original panel,
+    affine is the geometry row's rotated to original transform'''
+    xpos = affine[0]*points[:,1] + affine[1]*points[:,0] + affine[2]
+    ypos = affine[3]*points[:,1] + affine[4]*points[:,0] + affine[5]
+    return np.column_stack([ypos, xpos])
+
+def readworld(path):
+    #the six values of a world file, NaN if there is none
+    try:
+        with open(path,'r') as world:
+            constants = [float(line.rstrip()) for line in world if line.strip()]
+    except(IOError, ValueError):
+        return np.full(6, np.nan)
+    if len(constants) != 6:
+        return np.full(6, np.nan)
+    return np.array(constants)
+
+def worldfile(num, extension='.PGw'):
+    '''the six values of a panel's world file, NaN if there is none
+    in scene mode the scene's world file (extension, the usual one for its format, or .wld)
+    is moved to the corner of tile num's window'''
+    if SCENE is None:
+        return readworld('%s%s%s%s'%(PATH,FNM,num,extension))
+    root, ext = os.path.splitext(SCENE)
+    for world in [extension, ext[:2]+ext[-1:]+'w', '.wld']:
+        constants = readworld(root+world)
+        if np.all(np.isnan(constants)):
+            constants = readworld(root+world.lower())
+        if not np.all(np.isnan(constants)):
+            break
+    y0, x0 = scenetiles()[num][1][0::2]
+    constants[4]+=constants[0]*x0 + constants[2]*y0
+    constants[5]+=constants[1]*x0 + constants[3]*y0
+    return constants
+
+def recordgeometry(runfile, num, oshape, shape, source=None):
+    '''saves the geometry row of a panel from the shapes of the original and rotated images'''
+    if source is None:
+        source = np.full(6, np.nan)
+    affine = panelrotation(oshape, ROTANG)[0][:2].ravel()
+    row = np.concatenate([shape[:2], oshape[:2], worldfile(num), [ROTANG], affine, source]).astype(float)
+    try:
+        np.save(geometrypath(runfile, num), row)
+    except(IOError):
+        pass
+    return row
+
+def panelgeometry(runfile, maxnum, extension='.PGw'):
+    '''the scene geometry table of panels 0 to maxnum, a dictionary of arrays:
+    shape, oshape - rotated and original panel shapes, world - world file values, rotang - ROTANG,
+    affine - rotated to original pixel transform
+    panels without a record (run before they were kept) get one from their flagged image and png,
+    rows of panels with neither are NaN
+    '''
+    rows = np.array([geometryrow(runfile, i) for i in range(maxnum+1)]).reshape(-1,GEOMCOLS)
+    world = rows[:,4:10]
+    if extension != '.PGw':
+        world = np.array([worldfile(i, extension) for i in range(maxnum+1)]).reshape(-1,6)
+    return {'shape':rows[:,0:2], 'oshape':rows[:,2:4], 'world':world, 'rotang':rows[:,10], 'affine':rows[:,11:17]}
+
+def geometryrow(runfile, num):
+    #the geometry row of one panel, see panelgeometry
+    try:
+        row = np.load(geometrypath(runfile, num))
+        if len(row) == GEOMCOLS:
+            return row
+        #rows kept before the affine or the full panel source were, ROTANG and the shapes are enough to make it
+        affine = panelrotation(row[2:4].astype(int), row[10])[0][:2].ravel()
+        return np.concatenate([row[:11], affine, np.full(6, np.nan)])
+    except(IOError, ValueError):
+        pass
+    try:
+        seg = loadlabels(labelpath(runfile,num,'flagged'))
+        o_image = panelimage(num)
+    except(IOError, ValueError, SyntaxError, IndexError):
+        return np.full(GEOMCOLS, np.nan)
+    return recordgeometry(runfile, num, o_image.shape, seg.shape)
+
 def LROCAdapter():
     '''this code is  intended as a quick fix to looking at LROC images, longer term
 better infrastructure should be put in place to make this smoother'''
@@ -1879,6 +3259,53 @@ def plotborder(array):
     plt.plot(xdat, ydat, "o")
     return
 
+#in-memory copies of the RDRCUMINDEX.TAB indices, by path
+CUMINDEX = {}
+
+def cumindex(path = REFPATH):
+    '''
+    product ID -> byte offset index of the lines of RDRCUMINDEX.TAB
+    built once and saved next to the TAB file as RDRCUMINDEX.idx, it is rebuilt only when
+    the size or modification time of the TAB file changes. returns None if there is no TAB file
+    '''
+    tabfile = path + 'RDRCUMINDEX.TAB'
+    idxfile = path + 'RDRCUMINDEX.idx'
+    try:
+        stat = os.stat(tabfile)
+    except(OSError):
+        return None
+    key = (stat.st_size, stat.st_mtime)
+    if path in CUMINDEX and CUMINDEX[path][0] == key:
+        return CUMINDEX[path][1]
+    index = None
+    try:
+        with open(idxfile,'rb') as load:
+            saved = pickle.load(load)
+        if saved[0] == key:
+            index = saved[1]
+    except(IOError, EOFError, pickle.UnpicklingError, IndexError, TypeError):
+        pass
+    if index is None:
+        index = {}
+        offset = 0
+        with open(tabfile,'rb') as tab:
+            for line in tab:
+                dat = line.split(b',')
+                if len(dat) > 5:
+                    pid = dat[5].replace(b" ", b"").replace(b'"', b'').decode()
+                    #the first line for a product is the one that gets used
+                    if pid not in index:
+                        index[pid] = offset
+                offset+=len(line)
+        try:
+            with open(idxfile,'wb') as save:
+                pickle.dump((key,index),save)
+        except(IOError):
+            #read only reference folder, the index just lives in memory
+            pass
+    CUMINDEX[path] = (key,index)
+    return index
+
 ##Also Very important
 def getangles(ID, path = REFPATH):
     '''
@@ -1891,24 +3318,21 @@ def getangles(ID, path = REFPATH):
     '''
 
     #Modified to include debugging
-    try:
-        cumindex = open(path + 'RDRCUMINDEX.TAB', 'r')
-    except FileNotFoundError:
+    index = cumindex(path)
+    if index is None:
         print(f"Error: RDRCUMINDEX.TAB not found in {path}")
         return None, None, None, None, None, None
 
-    found = False
-    for line in cumindex:
+    #the index gives the byte offset of the product's line, only that line is read
+    found = ID in index
+    if found:
+        with open(path + 'RDRCUMINDEX.TAB', 'rb') as tab:
+            tab.seek(index[ID])
+            line = tab.readline().decode()
         dat = line.split(',')
         pid = dat[5].replace(" ", "").replace('"', '')
-
-        if pid == ID:
-            print(f"Parsed PID: {pid}")
-            print(f"Checking line: {line}")
-            found = True
-            break
-
-    cumindex.close()
+        print(f"Parsed PID: {pid}")
+        print(f"Checking line: {line}")
 
     if not found:
         print(f"\ngetangle error 2: No such HiRISE image found for ID {ID} in {path+'RDRCUMINDEX.TAB'}, check product ID or update CUMINDEX file\n")
@@ -2125,7 +3549,7 @@ Also could probably drop most of it (just the ID and the projection)
         
 
 ########INITIALIZATION##########
-INANGLE,SUNANGLE,RESOLUTION,NAZ, SAZ, ROTANG = start()
+#the geometry is no longer read at import, start() or geometry() set it up when a run needs it
 
 
     
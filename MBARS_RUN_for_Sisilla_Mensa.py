@@ -12,22 +12,23 @@ import os
 
 image = '/path<MBARSfolder/MBARS/Images/ESP_036925_1985_REDA/ESP_036925_1985_REDA0.PNG' #customise
 
-#check if the file exists
-if os.path.exists(image):
-    print(f"File {image} exists.")
-else:
-    print(f"File {image} does not exist.")
-
-#try opening the image
-try:
-    with Image.open(image) as img:
-        img.show()
-    print("Image opened successfully.")
-except Exception as e:
-    print(f"Error opening image: {e}")
-    
-Image_Area = len(image)*(len(image[0]))
-print(f'Image Area:{Image_Area} pixels^2')
+if __name__ == '__main__':
+    #check if the file exists
+    if os.path.exists(image):
+        print(f"File {image} exists.")
+    else:
+        print(f"File {image} does not exist.")
+
+    #try opening the image
+    try:
+        with Image.open(image) as img:
+            img.show()
+        print("Image opened successfully.")
+    except Exception as e:
+        print(f"Error opening image: {e}")
+
+    Image_Area = len(image)*(len(image[0]))
+    print(f'Image Area:{Image_Area} pixels^2')
 
 
 # In[2]:
@@ -37,25 +38,26 @@ print(f'Image Area:{Image_Area} pixels^2')
 #define a file path
 file_path = '/path<MBARSfolder/MBARS/Images/ESP_036925_1985_REDA/ESP_036925_1985_REDA0.PGw' #customise
 
-#open and read the contents of the world file
-with open(file_path, 'r') as file:
-    lines = file.readlines()
+if __name__ == '__main__':
+    #open and read the contents of the world file
+    with open(file_path, 'r') as file:
+        lines = file.readlines()
 
-#Extract the values
-pixel_size_x = float(lines[0].strip())
-rotation_row = float(lines[1].strip())
-rotation_column = float(lines[2].strip())
-pixel_size_y = float(lines[3].strip())
-upper_left_x = float(lines[4].strip())
-upper_left_y = float(lines[5].strip())
+    #Extract the values
+    pixel_size_x = float(lines[0].strip())
+    rotation_row = float(lines[1].strip())
+    rotation_column = float(lines[2].strip())
+    pixel_size_y = float(lines[3].strip())
+    upper_left_x = float(lines[4].strip())
+    upper_left_y = float(lines[5].strip())
 
-#print the extracted values
-print(f"Pixel size in x-direction: {pixel_size_x}")
-print(f"Rotation term for row: {rotation_row}")
-print(f"Rotation term for column: {rotation_column}")
-print(f"Pixel size in y-direction: {pixel_size_y}")
-print(f"X-coordinate of the center of the upper left pixel: {upper_left_x}")
-print(f"Y-coordinate of the center of the upper left pixel: {upper_left_y}")
+    #print the extracted values
+    print(f"Pixel size in x-direction: {pixel_size_x}")
+    print(f"Rotation term for row: {rotation_row}")
+    print(f"Rotation term for column: {rotation_column}")
+    print(f"Pixel size in y-direction: {pixel_size_y}")
+    print(f"X-coordinate of the center of the upper left pixel: {upper_left_x}")
+    print(f"Y-coordinate of the center of the upper left pixel: {upper_left_y}")
 
 
 # In[3]:
@@ -64,14 +66,15 @@ print(f"Y-coordinate of the center of the upper left pixel: {upper_left_y}")
 # Define the directory path
 directory_path = '/nfs/cfs/home3/ucfa/ucfajsr/MBARS/RefData2/'
 
-# Check if the directory exists
-if os.path.exists(directory_path):
-    print(f"Contents of directory: {directory_path}:")
-    # List all files and directories in the specified path
-    for item in os.listdir(directory_path):
-        print(item)
-else:
-    print(f"The directory {directory_path} does not exist.")
+if __name__ == '__main__':
+    # Check if the directory exists
+    if os.path.exists(directory_path):
+        print(f"Contents of directory: {directory_path}:")
+        # List all files and directories in the specified path
+        for item in os.listdir(directory_path):
+            print(item)
+    else:
+        print(f"The directory {directory_path} does not exist.")
 
 
 # In[4]:
@@ -173,6 +176,17 @@ startat = 0
 #Process is largely processer-limited, so benefit to large number of threads is minimal
 #setting no limit causes memory errors.
 thread_limit = 16
+#run panels in separate processes (True) or in threads (False), processes fit without the ODR lock
+#so throughput scales with the number of cores, run this as a script so the workers can import it,
+#everything that does work here sits under __main__ checks and is skipped when a worker does
+use_processes = True
+#number of worker processes, None uses all the cores
+process_limit = None
+#run on one large raster in the image folder (i.e. 'ESP_036925_1985_RED.IMG') instead of the
+#pre-cut panels, it is read in tiles of tile_size pixels with a halo of tile_halo pixels
+scene = None
+tile_size = 2048
+tile_halo = 64
 
 
 #This function is responsible for processing each image partition
@@ -183,13 +197,22 @@ def core(num,gam,plot,manbound,bound,odr_keycard):
     #print 'step 1 done'
     if good:
         if any(seg.compressed()):
-            bads = MBARS.boulderdetect_threadsafe(num,seg,runfile,odr_keycard)
+            #detection and merging in memory, set MBARS.STAGEDRUN to run them through the .shad file
             #MBARS.overlapcheck_threadsafe_DBSCAN(num,runfile, odr_keycard, overlap=.001)
-            MBARS.overlapcheck_shadbased(num,runfile,odr_keycard)
+            MBARS.panelshadows(num,seg,runfile,odr_keycard)
     if num%200 == 0:
         print ('Done with image %s'%(num))
     return runfile
 
+#called by the process pool as each panel finishes
+def panel_done(future):
+    if future.exception() is not None:
+        print ('panel failed: %s'%(future.exception()))
+        return
+    num, runfile = future.result()
+    if num%200 == 0:
+        print ('Done with image %s'%(num))
+
 def thread_run(filename,plot,startat, frac):
     print(f"processing file: {filename}")
     MBARS.FNM, MBARS.ID, MBARS.NOMAP,panels = MBARS.RunParams(filename)
@@ -201,6 +224,9 @@ def thread_run(filename,plot,startat, frac):
     MBARS.INANGLE, MBARS.SUNANGLE, MBARS.RESOLUTION, MBARS.NAZ, MBARS.SAZ, MBARS.ROTANG = MBARS.start()
     print(f"\nInitialisation values:\n INANGLE: {MBARS.INANGLE},\n SUNANGLE: {MBARS.SUNANGLE},\n RESOLUTION: {MBARS.RESOLUTION},\n "
           f"NAZ: {MBARS.NAZ},\n SAZ: {MBARS.SAZ},\n ROTANG: {MBARS.ROTANG}")
+    if scene is not None:
+        #the tiles of the scene take the place of the panels
+        panels = MBARS.openscene(MBARS.PATH+scene,tile_size,tile_halo)
     #set the proportion of the shadow to use here
     bound = MBARS.getimagebound(panels,frac)
     mangam = 0
@@ -210,8 +236,13 @@ def thread_run(filename,plot,startat, frac):
     threads = []
     krange = range(startat,panels)
     print ('%s images to run'%(panels))
+    if use_processes:
+        #every worker gets the run settings explicitly rather than reading MBARS globals
+        config = MBARS.runconfig(bound)
+        MBARS.processrun(panels,config,workers=process_limit,startat=startat,callback=panel_done)
     odr_keycard = threading.Lock()
-    threads = [threading.Thread(target = core, args=(a,mangam,plot,manbound,bound,odr_keycard),name='%s'%(a)) for a in krange]
+    if not use_processes:
+        threads = [threading.Thread(target = core, args=(a,mangam,plot,manbound,bound,odr_keycard),name='%s'%(a)) for a in krange]
     count=0
     for i in range(len(threads)):
         runfile = threads[i].start()
@@ -246,15 +277,16 @@ def thread_run(filename,plot,startat, frac):
 #for i in filenames:
     #mangam, manbound = MBARS.FindIdealParams(i)
 
-#Set up the files before running all of them
-for i in filenames:
-    print (i)
-    a,b,c,d = MBARS.RunParams(i)
-#actually run the analysis on all of them
-for i in filenames:
-    for j in FRACS:
-        PNLS = thread_run(i,plot,startat,j)
-        MBARS.OutToGIS('autobound//','autobound_'+str(j)+'//',PNLS)
+if __name__ == '__main__':
+    #Set up the files before running all of them
+    for i in filenames:
+        print (i)
+        a,b,c,d = MBARS.RunParams(i)
+    #actually run the analysis on all of them
+    for i in filenames:
+        for j in FRACS:
+            PNLS = thread_run(i,plot,startat,j)
+            MBARS.OutToGIS('autobound//','autobound_'+str(j)+'//',PNLS)
 
 
 # ## Analysis
@@ -277,7 +309,8 @@ from MBARS import plotCFArefs, PSD, GolomPSDCFA, checkbads, ExamineImage, FindBi
 # In[7]:
 
 
-current()
+if __name__ == '__main__':
+    current()
 
 
 # ### Test getshad
@@ -332,7 +365,8 @@ def test_getshads(runfile, num):
         print(f"Failed to open or process file: {e}")
 
 # Example usage
-test_getshads(runfile, num)
+if __name__ == '__main__':
+    test_getshads(runfile, num)
 
 
 # ### CFA
@@ -370,9 +404,11 @@ maxd = 10 #The maximum diameter in meters, check csv file
 fitmaxd = 10 #The maximum diameter for fitting
 root = f'ESP_036925_1985_RED with FRAC at: {FRACS}' #This will be the title of the Plot
 
-bulkCFA(runfile,maxnum,maxd,fitmaxd,root)
+if __name__ == '__main__':
+    #new='auto' reuses the panel CFAs unless their shadows changed, refs=1 plots the Golombek reference curves
+    bulkCFA(runfile,maxnum,maxd,fitmaxd,root,new='auto',refs=1)
 
-print('bulkCFA run completed')
+    print('bulkCFA run completed')
 
 
 # # Validation
@@ -385,5 +421,6 @@ print('bulkCFA run completed')
 showblanks = True #set true to show black images
 filt = True #set true to apply filtering
 
-ExamineImage(runfile,num, showblanks,filt = True)
+if __name__ == '__main__':
+    ExamineImage(runfile,num, showblanks,filt = True)
 